@@ -44,6 +44,11 @@ class NoProvider(UnicodeException):
     pass
 
 
+class DocumentFrozen(UnicodeException):
+    """The document is frozen and can't be modified."""
+    pass
+
+
 class XMLNamespace:
     '''A handy structure to repsent names in an XML namespace.'''
 
@@ -91,6 +96,14 @@ class DocProvider:
         """Should return a file-like object with a WL document XML."""
         raise NotImplementedError
 
+    def stat(self, slug):
+        """
+        Returns a value which changes whenever the document changes.
+
+        Used for validating caches. None means it's not known.
+        """
+        return None
+
 
 class DirDocProvider(DocProvider):
     """ Serve docs from a directory of files in form <slug>.xml """
@@ -103,6 +116,10 @@ class DirDocProvider(DocProvider):
         fname = slug + '.xml'
         return open(os.path.join(self.dir, fname), 'rb')
 
+    def stat(self, slug):
+        st = os.stat(os.path.join(self.dir, slug + '.xml'))
+        return st.st_mtime_ns, st.st_size
+
 
 def get_resource(path):
     return os.path.join(os.path.dirname(__file__), path)
@@ -6,12 +6,13 @@ import io
 import os
 import re
 import tempfile
+import zipfile
 from ebooklib import epub
 from lxml import etree
 from librarian import functions, OutputFile, get_resource, XHTMLNS
 from librarian.cover import make_cover
 from librarian.embeds.mathml import MathML
-from librarian.fonts import strip_font
+from librarian import fonts
 
 
 class Xhtml:
@@ -27,6 +28,58 @@ class Xhtml:
         return self.element.find('.//' + XHTMLNS('body'))
 
 
+class StreamingEpubWriter(epub.EpubWriter):
+    """
+    Writes the EPUB container while the book is being built.
+
+    Items given to `write_item` go into the zip right away and their
+    content is dropped, so the book only keeps a lightweight manifest.
+    The package document, NCX and nav are generated from it on `close`.
+    """
+    def __init__(self, name, book, options=None):
+        super().__init__(name, book, options)
+        self.written = set()
+        self.out = zipfile.ZipFile(
+            name, 'w', zipfile.ZIP_DEFLATED,
+            compresslevel=self.options['compresslevel']
+        )
+        self.out.writestr(
+            'mimetype', 'application/epub+zip',
+            compress_type=zipfile.ZIP_STORED
+        )
+        self._write_container()
+
+    def write_item(self, item):
+        if isinstance(item, epub.EpubNcx):
+            content = self._get_ncx()
+        elif isinstance(item, epub.EpubNav):
+            content = self._get_nav(item)
+        else:
+            content = item.get_content()
+        if item.manifest:
+            name = '/'.join((self.book.FOLDER_NAME, item.file_name))
+        else:
+            name = item.file_name
+        self.out.writestr(name, content)
+        item.content = b''
+        self.written.add(item)
+
+    def _write_items(self):
+        for item in self.book.get_items():
+            if item not in self.written:
+                self.write_item(item)
+
+    def close(self):
+        self.process()
+        self._write_items()
+        self._write_opf()
+        self.out.close()
+
+    def abort(self):
+        self.out.close()
+        os.unlink(self.file_name)
+
+
 class Builder:
     file_extension = None
 
@@ -42,19 +95,40 @@ class Builder:
             'footnotes': self.footnotes,
         }
         self.current_cursors = []
+        # Text waiting to be added to the current cursor.
+        self.pending_text = []
+
+        # Per-build data about source elements, which is never written
+        # into the document itself.
+        self.element_settings = {}
 
         self.toc_base = 0
 
     @property
     def cursor(self):
+        self.flush_text()
         return self.current_cursors[-1]
 
     def enter_fragment(self, fragment):
+        self.flush_text()
         self.current_cursors.append(self.cursors[fragment])
 
     def exit_fragment(self):
+        self.flush_text()
         self.current_cursors.pop()
 
+    def flush_text(self):
+        """Adds all the pending text to the current cursor at once."""
+        if not self.pending_text:
+            return
+        text = ''.join(self.pending_text)
+        self.pending_text.clear()
+        cursor = self.current_cursors[-1]
+        if len(cursor):
+            cursor[-1].tail = (cursor[-1].tail or '') + text
+        else:
+            cursor.text = (cursor.text or '') + text
+
     def create_fragment(self, name, element):
         assert name not in self.cursors
         self.cursors[name] = element
@@ -80,6 +154,8 @@ class EpubBuilder(Builder):
     file_extension = 'epub'
     isbn_field = 'isbn_epub'
     orphans = True
+    font_files = ('DejaVuSerif.ttf', 'DejaVuSerif-Bold.ttf',
+                  'DejaVuSerif-Italic.ttf', 'DejaVuSerif-BoldItalic.ttf')
 
     def __init__(self, *args, debug=False, **kwargs):
         self.numbering = 0
@@ -89,7 +165,19 @@ class EpubBuilder(Builder):
         self.splits = []
         super().__init__(*args, **kwargs)
     
-    def build(self, document, **kwargs):
+    def build(self, document, font_workers=None, font_format='ttf',
+              **kwargs):
+        """
+        The fonts are subset in a shared pool of `font_workers` processes
+        (one per CPU by default; 1 subsets them in this process). Fonts are embedded as `font_format`: ttf, woff or woff2.
+
+        The EPUB file is written while building: every chunk goes into it
+        as soon as it's closed.
+        """
+        fonts.check_format(font_format)
+        self.font_workers = font_workers
+        self.font_format = font_format
+
         # replace_characters -- nie, robimy to na poziomie elementów
         
         # hyphenator (\00ad w odp. miejscach) -- jeśli już, to też powinno to się dziać na poziomie elementów
@@ -109,7 +197,22 @@ class EpubBuilder(Builder):
         # @thanks = meta.thanks
 
 
-        self.output = output = epub.EpubBook()
+        output_file = tempfile.NamedTemporaryFile(
+            prefix='librarian', suffix='.epub',
+            delete=False)
+        output_file.close()
+        self.output = epub.EpubBook()
+        self.writer = StreamingEpubWriter(
+            output_file.name, self.output, {'epub3_landmark': False})
+        try:
+            self.build_book(document)
+        except BaseException:
+            self.writer.abort()
+            raise
+        self.writer.close()
+        return OutputFile.from_filename(output_file.name)
+
+    def build_book(self, document):
         self.document = document
 
         self.set_metadata()
@@ -162,13 +265,6 @@ class EpubBuilder(Builder):
 
         self.add_fonts()
 
-        output_file = tempfile.NamedTemporaryFile(
-            prefix='librarian', suffix='.epub',
-            delete=False)
-        output_file.close()
-        epub.write_epub(output_file.name, output, {'epub3_landmark': False})
-        return OutputFile.from_filename(output_file.name)
-
     def build_document(self, document):
         self.toc_precedences = []
 
@@ -332,8 +428,17 @@ class EpubBuilder(Builder):
             get_resource('res/jedenprocent.png'),
             media_type='image/png'
         )
+        with open(get_resource('res/epub/style.css'), 'rb') as f:
+            style = f.read()
+        font_format = getattr(self, 'font_format', 'ttf')
+        for fname in self.font_files:
+            style = style.replace(
+                b'url(%s)' % fname.encode(),
+                b'url(%s)' % fonts.get_file_name(fname, font_format).encode()
+            )
         self.add_file(
-            get_resource('res/epub/style.css'),
+            content=style,
+            file_name='style.css',
             media_type='text/css'
         )
 
@@ -363,6 +468,7 @@ class EpubBuilder(Builder):
         )
 
         self.output.add_item(item)
+        self.writer.write_item(item)
         if spine:
             if spine is True:
                 self.output.spine.append(item)
@@ -392,18 +498,22 @@ class EpubBuilder(Builder):
             
         
     def add_fonts(self):
-        for fname in ('DejaVuSerif.ttf', 'DejaVuSerif-Bold.ttf',
-                      'DejaVuSerif-Italic.ttf', 'DejaVuSerif-BoldItalic.ttf'):
+        font_format = getattr(self, 'font_format', 'ttf')
+        contents = fonts.strip_fonts(
+            [get_resource('fonts/' + fname) for fname in self.font_files],
+            self.chars,
+            workers=getattr(self, 'font_workers', None),
+            font_format=font_format
+        )
+        for fname, content in zip(self.font_files, contents):
             self.add_file(
-                content=strip_font(
-                    get_resource('fonts/' + fname),
-                    self.chars
-                ),
-                file_name=fname,
-                media_type='font/ttf'
+                content=content,
+                file_name=fonts.get_file_name(fname, font_format),
+                media_type=fonts.FORMATS[font_format][1]
             )
 
     def start_chunk(self):
+        self.flush_text()
         if getattr(self, 'current_chunk', None) is not None:
             if not len(self.current_chunk):
                 return
@@ -449,14 +559,12 @@ class EpubBuilder(Builder):
         )
         
     def end_element(self):
+        self.flush_text()
         self.current_cursors.pop()
         
     def push_text(self, text):
         self.chars.update(text)
-        if len(self.cursor):
-            self.cursor[-1].tail = (self.cursor[-1].tail or '') + text
-        else:
-            self.cursor.text = (self.cursor.text or '') + text
+        self.pending_text.append(text)
 
 
     def assign_image_number(self):
@@ -680,6 +788,7 @@ class EpubBuilder(Builder):
             content=cover_file.getvalue(),
             create_page = False
         )
+        self.writer.write_item(self.output.get_item_with_id('cover-img'))
         ci = ('''<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE html>
 <html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en" xml:lang="en">
@@ -3,11 +3,19 @@
 #
 from urllib.request import urlopen
 from lxml import etree
-from librarian.html import add_anchors, add_table_of_contents, add_table_of_themes
+from librarian.html import (make_anchor, make_table_of_contents,
+                            make_table_of_themes, raw_printable_text)
 from librarian import OutputFile
 
 
 class HtmlBuilder:
+    """
+    Builds HTML from a document.
+
+    Anchors, table of contents and themes are collected while building,
+    as the elements are started. Each cursor knows which fragment it's in
+    and whether its content gets anchors and TOC entries.
+    """
     file_extension = "html"
     with_anchors = True
     with_themes = True
@@ -35,6 +43,22 @@ class HtmlBuilder:
             'nota_red': self.nota_red,
         }
         self.current_cursors = [text]
+        # Text waiting to be added to the current cursor.
+        self.pending_text = []
+
+        # Cursor -> (fragment, gets anchors, gets TOC entries).
+        # These are only enabled when building a whole document.
+        self.cursor_contexts = {
+            text: (None, False, False),
+            self.header: ('header', False, False),
+            self.footnotes: ('footnotes', False, False),
+            self.nota_red: ('nota_red', False, False),
+        }
+        self.anchor_prefix = 'f'
+        self.anchor_counters = {'f': 1}
+        self.visible_counter = 1
+        self.toc_headers = []
+        self.themes = []
 
     @property
     def base_url(self):
@@ -45,6 +69,7 @@ class HtmlBuilder:
 
     @property
     def cursor(self):
+        self.flush_text()
         return self.current_cursors[-1]
 
     def enter_fragment(self, fragment):
@@ -52,24 +77,30 @@ class HtmlBuilder:
         self.current_cursors.append(cursor)
 
     def exit_fragment(self):
+        self.flush_text()
         self.current_cursors.pop()
 
     def create_fragment(self, name, element):
         assert name not in self.cursors
         self.cursors[name] = element
+        self.cursor_contexts[element] = self.cursor_contexts[self.cursor]
 
     def forget_fragment(self, name):
         del self.cursors[name]
 
     def preprocess(self, document):
-        document._compat_assign_ordered_ids()
-        document._compat_assign_section_ids()
+        document.prepare()
 
     def build(self, document, **kwargs):
         self.document = document
 
         self.preprocess(document)
+        for fragment in (None, 'header'):
+            self.cursor_contexts[self.cursors[fragment]] = (
+                fragment, self.with_anchors, self.with_toc
+            )
         document.tree.getroot().html_build(self)
+        self.flush_text()
         self.postprocess(document)
         return self.output()
 
@@ -101,14 +132,24 @@ class HtmlBuilder:
         if len(self.header):
             self.tree.insert(0, self.header)
             
-        if self.with_anchors:
-            add_anchors(self.tree)
         if self.with_nota_red and len(self.nota_red):
             self.tree.append(self.nota_red)
         if self.with_themes:
-            add_table_of_themes(self.tree)
+            # Only themes from fragments which made it into the tree so far,
+            # in the order of the tree.
+            order = {'header': 0, None: 1, 'nota_red': 2}
+            self.tree.insert(0, make_table_of_themes(
+                element for fragment, element in sorted(
+                    self.themes, key=lambda theme: order.get(theme[0], 3)
+                )
+                if fragment is None
+                or self.cursors[fragment].getparent() is not None
+            ))
         if self.with_toc:
-            add_table_of_contents(self.tree)
+            self.tree.insert(0, make_table_of_contents(
+                (number, element.tag, raw_printable_text(element))
+                for number, element in self.toc_headers
+            ))
 
         if self.footnote_counter:
             fnheader = etree.Element("h3")
@@ -117,17 +158,76 @@ class HtmlBuilder:
             self.tree.append(self.footnotes)
 
     def start_element(self, tag, attrib=None):
-        self.current_cursors.append(etree.SubElement(
-            self.cursor,
-            tag,
-            **(attrib or {})
-        ))
+        attrib = attrib or {}
+        cursor = self.cursor
+        fragment, with_anchors, with_toc = self.cursor_contexts[cursor]
+        html_class = attrib.get('class') or ''
+
+        if with_anchors:
+            self.add_anchors(tag, attrib, html_class)
+        if with_toc and tag in ('h2', 'h3'):
+            number = len(self.toc_headers) + 1
+            cursor.extend(make_anchor("s%d" % number, with_link=False))
+
+        element = etree.SubElement(cursor, tag, **attrib)
+        self.current_cursors.append(element)
+
+        if tag == 'a' and html_class == 'theme-begin':
+            self.themes.append((fragment, element))
+        if with_toc and tag in ('h2', 'h3'):
+            self.toc_headers.append((number, element))
+
+        if attrib.get('id') in ('footnotes', 'nota_red'):
+            with_anchors = with_toc = False
+        if html_class in (
+                'note', 'motto', 'motto_podpis', 'dedication', 'frame'
+        ) or tag == 'blockquote':
+            with_anchors = False
+        if html_class == 'person-list':
+            with_toc = False
+        self.cursor_contexts[element] = fragment, with_anchors, with_toc
+
+    def add_anchors(self, tag, attrib, html_class):
+        """Puts numbered anchors before paragraphs and verses."""
+        if html_class == 'numeracja':
+            try:
+                self.visible_counter = int(attrib.get('data-start'))
+            except (TypeError, ValueError):
+                self.visible_counter = 1
+            if attrib.get('data-link'):
+                self.anchor_prefix = attrib['data-link']
+                self.anchor_counters[self.anchor_prefix] = 1
+
+        if tag == 'div' and 'verse' in html_class:
+            with_link = self.visible_counter == 1 or self.visible_counter % 5 == 0
+        elif 'paragraph' in html_class:
+            with_link = True
+        else:
+            return
+
+        prefix = self.anchor_prefix
+        if with_link:
+            self.cursor.extend(make_anchor(
+                "%s%d" % (prefix, self.anchor_counters[prefix]),
+                link_text=self.visible_counter
+            ))
+        self.anchor_counters[prefix] += 1
+        self.visible_counter += 1
 
     def end_element(self):
+        self.flush_text()
         self.current_cursors.pop()
 
     def push_text(self, text):
-        cursor = self.cursor
+        self.pending_text.append(text)
+
+    def flush_text(self):
+        """Adds all the pending text to the current cursor at once."""
+        if not self.pending_text:
+            return
+        text = ''.join(self.pending_text)
+        self.pending_text.clear()
+        cursor = self.current_cursors[-1]
         if len(cursor):
             cursor[-1].tail = (cursor[-1].tail or '') + text
         else:
@@ -9,6 +9,15 @@ from librarian.hyphenator import Hyphenator
 from .epub import EpubBuilder
 
 
+def iter_texts(document):
+    """Iterates over the texts of the document and all its parts."""
+    yield from document.tree.getroot().itertext()
+    for child in document.children:
+        # Parts that failed to load are left for the EPUB build to report.
+        if not isinstance(child, Exception):
+            yield from iter_texts(child)
+
+
 class MobiBuilder(EpubBuilder):
     file_extension = 'mobi'
     isbn_field = 'isbn_mobi'
@@ -21,6 +30,8 @@ class MobiBuilder(EpubBuilder):
                                        short_lng + '.dic'))
         except:
             pass
+        else:
+            self.hyphenator.prehyphenate(iter_texts(document), '\u00AD')
 
         epub = super().build(document, **kwargs)
 
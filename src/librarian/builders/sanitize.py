@@ -8,10 +8,14 @@ from librarian import OutputFile
 class Sanitizer:
     identifier = 'sanitize'
     file_extension = 'xml2'
+    modifies_document = True
 
     def build(self, document, **kwargs):
+        document.check_not_frozen()
         doc = document.tree.getroot() # TODO: copy
         doc.sanitize()
+        # Preprocessed data no longer matches the tree.
+        document.prepared = None
         return OutputFile.from_bytes(
             etree.tostring(
                 doc,
@@ -2,12 +2,86 @@
 # Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
 #
 import argparse
+import json
 import os.path
+import sys
+from . import get_resource
 from .builders import builders
+from .builders.epub import EpubBuilder
 from .document import WLDocument
+from .fonts import get_size_report
+from .index import MetadataIndex
+
+
+def index_main():
+    parser = argparse.ArgumentParser(
+        prog='librarian index',
+        description="Updates or queries a metadata index of a directory of books."
+    )
+    parser.add_argument('index_file')
+    parser.add_argument(
+        'input_dir', nargs='?',
+        help='updates the index with the books in this directory'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, metavar='N',
+        help='number of worker processes'
+    )
+    parser.add_argument(
+        '-s', '--show', metavar='SLUG',
+        help='shows the metadata of a book'
+    )
+    args = parser.parse_args(sys.argv[2:])
+
+    with MetadataIndex(args.index_file) as index:
+        if args.input_dir:
+            updated, removed, errors = index.update(
+                args.input_dir, workers=args.jobs)
+            for file_name, error in errors.items():
+                print('%s: %s' % (file_name, error), file=sys.stderr)
+            print('Updated: %d, removed: %d, errors: %d.' % (
+                len(updated), len(removed), len(errors)))
+        if args.show:
+            if args.show not in index:
+                parser.exit(1, 'No book %s in the index.\n' % args.show)
+            info = index.get(args.show)
+            info['parents'] = index.get_parents(args.show)
+            print(json.dumps(info, indent=2, ensure_ascii=False))
+
+
+def font_report_main():
+    parser = argparse.ArgumentParser(
+        prog='librarian font-report',
+        description="Prints the sizes of EPUB fonts in each format, subset for the given books."
+    )
+    parser.add_argument('input_file', nargs='+')
+    args = parser.parse_args(sys.argv[2:])
+
+    chars = set()
+    for file_name in args.input_file:
+        chars.update(*WLDocument(filename=file_name).tree.getroot().itertext())
+    report = get_size_report(
+        [get_resource('fonts/' + fname) for fname in EpubBuilder.font_files],
+        chars)
+    totals = {}
+    for fname, sizes in report:
+        for font_format, size in sizes.items():
+            totals[font_format] = totals.get(font_format, 0) + size
+    report.append(('Total', totals))
+    for fname, sizes in report:
+        print('{:<28}'.format(fname) + ''.join(
+            '{:>6} {:>8} {:>7.1%}'.format(
+                font_format, size, size / sizes['ttf'])
+            for font_format, size in sizes.items()
+        ))
 
 
 def main(*args, **kwargs):
+    if sys.argv[1:2] == ['index']:
+        return index_main()
+    if sys.argv[1:2] == ['font-report']:
+        return font_report_main()
+
     parser = argparse.ArgumentParser(description="PARSER DESCRIPTION")
 
     parser.add_argument(
@@ -37,6 +111,11 @@ def main(*args, **kwargs):
         nargs="*",
         help='specifies an MP3 file, if needed'
     )
+    parser.add_argument(
+        '--font-format',
+        choices=['ttf', 'woff', 'woff2'],
+        help='format of the embedded fonts, for EPUB'
+    )
 
     args = parser.parse_args()
     builder = builders[args.builder]
@@ -60,6 +139,8 @@ def main(*args, **kwargs):
     kwargs = {
         "mp3": args.mp3,
     }
+    if args.font_format:
+        kwargs['font_format'] = args.font_format
 
     output = document.build(builder, base_url=args.base_url, **kwargs)
     with open(output_file_path, 'wb') as f:
@@ -1,9 +1,12 @@
 # This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
 # Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
 #
+from concurrent.futures import ProcessPoolExecutor
 from xml.parsers.expat import ExpatError
 from datetime import date
 import io
+import os
+import pickle
 import time
 import re
 from librarian.util import roman_to_int
@@ -87,7 +90,28 @@ class Field:
         return False
 
 
+def make_alias(field):
+    """Singular alias of a multiple field: its first value."""
+    name = field.name
+
+    def get(self):
+        value = getattr(self, name)
+        return value[0] if value else None
+
+    def set(self, value):
+        setattr(self, name, [value])
+
+    return property(get, set)
+
+
 class DCInfo(type):
+    """
+    Collects the FIELDS of the class and its bases.
+
+    Every field is stored in a slot of its own name, and its singular
+    alias (if any) gets a property, so that reading a field costs no more
+    than a plain attribute access.
+    """
     def __new__(mcs, classname, bases, class_dict):
         fields = list(class_dict['FIELDS'])
 
@@ -100,10 +124,31 @@ class DCInfo(type):
                         fields.insert(0, field)
 
         class_dict['FIELDS'] = tuple(fields)
+
+        inherited = set()
+        for base in bases:
+            for klass in base.__mro__:
+                inherited.update(getattr(klass, '__slots__', ()))
+        slots = list(class_dict.get('__slots__', ()))
+        fmap = {}
+        fields_by_uri = {}
+        for field in fields:
+            if field.name not in inherited and field.name not in slots:
+                slots.append(field.name)
+            fmap[field.name] = field
+            if field.salias:
+                fmap[field.salias] = field
+                class_dict[field.salias] = make_alias(field)
+            fields_by_uri.setdefault(field.uri, field)
+        class_dict['__slots__'] = tuple(slots)
+        class_dict['fmap'] = fmap
+        class_dict['FIELDS_BY_URI'] = fields_by_uri
         return super(DCInfo, mcs).__new__(mcs, classname, bases, class_dict)
 
 
 class WorkInfo(metaclass=DCInfo):
+    __slots__ = ('about',)
+
     FIELDS = (
         Field(DCNS('creator'), 'authors', Person, salias='author',
               multiple=True, required=False),
@@ -145,10 +190,8 @@ class WorkInfo(metaclass=DCInfo):
 
     @classmethod
     def get_field_by_uri(cls, uri):
-        for f in cls.FIELDS:
-            if f.uri == uri:
-                return f
-    
+        return cls.FIELDS_BY_URI.get(uri)
+
     @classmethod
     def from_bytes(cls, xml, *args, **kwargs):
         return cls.from_file(io.BytesIO(xml), *args, **kwargs)
@@ -181,6 +224,42 @@ class WorkInfo(metaclass=DCInfo):
         except ExpatError as e:
             raise ParseError(e)
 
+    @classmethod
+    def from_header(cls, xmlfile, *args, chunk_size=16384, **kwargs):
+        """
+        Reads the metadata without parsing the rest of the document.
+
+        `xmlfile` is a file name or a binary file object. It's read in
+        chunks only up to the end of the rdf:RDF section, and only that
+        prefix is parsed.
+        """
+        if isinstance(xmlfile, (str, os.PathLike)):
+            with open(xmlfile, 'rb') as f:
+                return cls.from_header(
+                    f, *args, chunk_size=chunk_size, **kwargs)
+
+        pull = etree.XMLPullParser(['start', 'end'], tag=RDFNS('RDF'))
+        desc_tag = None
+        try:
+            while True:
+                data = xmlfile.read(chunk_size)
+                if not data:
+                    break
+                pull.feed(data)
+                for event, element in pull.read_events():
+                    if event == 'start':
+                        desc_tag = element
+                    elif element is desc_tag:
+                        return cls.from_element(desc_tag, *args, **kwargs)
+        except XMLSyntaxError as e:
+            raise ParseError(e)
+
+        if desc_tag is None:
+            raise NoDublinCore(
+                "DublinCore section not found. "
+                "Check if there are rdf:RDF and rdf:Description tags.")
+        raise ParseError("Unexpected end of file in the rdf:RDF section.")
+
     @classmethod
     def from_element(cls, rdf_tag, *args, **kwargs):
         # The tree is already parsed,
@@ -207,7 +286,7 @@ class WorkInfo(metaclass=DCInfo):
                 if meta_id and meta_id.endswith('-id'):
                     tag = meta_id
 
-            field = cls.get_field_by_uri(tag)
+            field = cls.FIELDS_BY_URI.get(tag)
             if field is None:
                 # Ignore unknown fields.
                 continue
@@ -232,42 +311,11 @@ class WorkInfo(metaclass=DCInfo):
         """
 
         self.about = rdf_attrs.get(RDFNS('about'))
-        self.fmap = {}
 
         for field in self.FIELDS:
             value = field.validate(dc_fields, fallbacks=fallbacks,
                                    strict=strict, validate_required=validate_required)
-            setattr(self, 'prop_' + field.name, value)
-            self.fmap[field.name] = field
-            if field.salias:
-                self.fmap[field.salias] = field
-
-    def __getattribute__(self, name):
-        try:
-            field = object.__getattribute__(self, 'fmap')[name]
-            value = object.__getattribute__(self, 'prop_'+field.name)
-            if field.name == name:
-                return value
-            else:  # singular alias
-                if not field.multiple:
-                    raise "OUCH!! for field %s" % name
-
-                return value[0] if value else None
-        except (KeyError, AttributeError):
-            return object.__getattribute__(self, name)
-
-    def __setattr__(self, name, newvalue):
-        try:
-            field = object.__getattribute__(self, 'fmap')[name]
-            if field.name == name:
-                object.__setattr__(self, 'prop_'+field.name, newvalue)
-            else:  # singular alias
-                if not field.multiple:
-                    raise "OUCH! while setting field %s" % name
-
-                object.__setattr__(self, 'prop_'+field.name, [newvalue])
-        except (KeyError, AttributeError):
-            return object.__setattr__(self, name, newvalue)
+            setattr(self, field.name, value)
 
     def update(self, field_dict):
         """
@@ -398,3 +446,39 @@ class BookInfo(WorkInfo):
 
 def parse(file_name, cls=BookInfo):
     return cls.from_file(file_name)
+
+
+def _scan(file_name, cls):
+    try:
+        return cls.from_header(file_name)
+    except (ParseError, ValidationError) as e:
+        # Wrapped lxml errors can't be sent back from the worker.
+        return type(e)(str(e))
+    except Exception as e:
+        # Any other error is returned too, so that one bad file
+        # doesn't stop the scan, but only if it can be unpickled.
+        try:
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            return ParseError('%s: %s' % (type(e).__name__, e))
+        return e
+
+
+def scan_dir(path, cls=BookInfo, workers=None, suffix='.xml'):
+    """
+    Reads the metadata of all the documents in a directory.
+
+    Only the header of each file is parsed (see `WorkInfo.from_header`),
+    in a pool of `workers` processes (by default, one per CPU).
+    Returns a dict mapping file names to info objects, or to the
+    exceptions raised for the files with broken or missing metadata.
+    """
+    file_names = sorted(
+        os.path.join(path, name) for name in os.listdir(path)
+        if name.endswith(suffix)
+    )
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        infos = executor.map(
+            _scan, file_names, [cls] * len(file_names),
+            chunksize=max(1, len(file_names) // 64))
+        return dict(zip(file_names, infos))
@@ -2,20 +2,141 @@
 # Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
 #
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy, deepcopy
 import gettext
+import hashlib
+from importlib.metadata import version, PackageNotFoundError
+import io
+from operator import itemgetter
 import os
+import pickle
 import re
+import tempfile
+import threading
 import urllib.request
 from lxml import etree
-from .parser import parser
-from . import dcparser, DCNS, RDFNS, DirDocProvider
+from .parser import get_parser
+from . import dcparser, DCNS, RDFNS, DirDocProvider, DocumentFrozen
+from .elements.base import CONTEXT_SETTINGS
+from .elements.masters import Master
+from .elements.root import Utwor
 from .functions import lang_code_3to2
+from .util import get_translation
+
+
+class IdRegistry:
+    """Keeps track of element ids used in a document."""
+
+    def __init__(self, prefix='e'):
+        self.prefix = prefix
+        self.used = set()
+        self.counter = 1
+
+    def __contains__(self, item):
+        return item in self.used
+
+    def add(self, item):
+        self.used.add(item)
+
+    def update(self, items):
+        self.used.update(items)
+
+    def next_id(self):
+        """Returns the next free id and marks it as used."""
+        while True:
+            candidate = f'{self.prefix}{self.counter}'
+            self.counter += 1
+            if candidate not in self.used:
+                self.used.add(candidate)
+                return candidate
+
+
+class ElementContext:
+    """
+    What an element inherits from its ancestors: metadata and settings.
+
+    Shared by all elements in the same scope; a new one is only created
+    where an element brings its own metadata or defines a setting.
+    """
+
+    def __init__(self, meta, owners=None):
+        self.meta = meta
+        # Setting name -> closest element defining it.
+        self.owners = owners or {}
+        self._translation = None
+
+    @property
+    def translation(self):
+        if self._translation is None:
+            self._translation = get_translation(self.meta.language)
+        return self._translation
+
+    def derive(self, element, meta=None, settings=()):
+        owners = self.owners
+        if settings:
+            owners = dict(owners)
+            for setting in settings:
+                owners[setting] = element
+        context = ElementContext(meta or self.meta, owners)
+        if meta is None:
+            context._translation = self._translation
+        return context
+
+
+class Preparation:
+    """Preprocessed data of a WLDocument, shared by all the builders."""
+
+    def __init__(self, document):
+        self.document = document
+        self.ordered_ids = {}
+        self.section_ids = {}
+        self.verses = {}
+        self.missing_ids = []
+        self.meta_objects = {}
+        self.contexts = {}
+        # Python attributes on lxml proxies only live as long as the proxies.
+        self.verse_roots = []
+
+    def register_copy(self, original, duplicate):
+        """Lets a copy of an element share the values of the original."""
+        for orig, dup in zip(original.iter(), duplicate.iter()):
+            for table in (self.ordered_ids, self.section_ids, self.contexts):
+                value = table.get(orig)
+                if value is not None:
+                    table[dup] = value
+
+    def register_verse(self, verse, stanza):
+        """Makes a verse split out of a stanza a part of the document."""
+        verse.document = self.document
+        self.contexts[verse] = self.contexts.get(stanza)
+        self.verse_roots.append(verse)
+
+    def get_own_meta(self, element):
+        """Returns metadata defined by the element itself, if any."""
+        if element in self.meta_objects:
+            return self.meta_objects[element]
+        if isinstance(element, Utwor):
+            # Deprecated: allow RDF record in master.
+            for child in element:
+                if isinstance(child, Master) and child in self.meta_objects:
+                    return self.meta_objects[child]
 
 
 class WLDocument:
-    def __init__(self, filename=None, url=None, provider=None):
-        source = filename or urllib.request.urlopen(url)
-        tree = etree.parse(source, parser=parser)
+    LINE_SWAP_EXPR = re.compile(r'/\s', re.MULTILINE | re.UNICODE)
+
+    def __init__(self, filename=None, url=None, provider=None, tree=None):
+        """
+        Parses the document from a file name, a file object or an URL.
+
+        An already parsed `tree` can be given instead; it's assumed
+        to have been validated.
+        """
+        parsed = tree is None
+        if parsed:
+            source = filename or urllib.request.urlopen(url)
+            tree = etree.parse(source, parser=get_parser())
         self.tree = tree
         tree.getroot().document = self
         self.base_meta = dcparser.BookInfo({}, {
@@ -23,8 +144,57 @@ class WLDocument:
         }, validate_required=False)
 
         self.provider = provider if provider is not None else DirDocProvider('.')
+        self.ids = IdRegistry()
+        self.prepared = None
+        self.prepare_lock = threading.Lock()
+        self.frozen = False
+        # Slug -> loaded part document, or the error from parsing it.
+        self.parts = {}
+        self.parts_lock = threading.Lock()
+
+        if parsed:
+            self.tree.getroot().validate()
+
+    def __deepcopy__(self, memo):
+        """Copies the tree, but not the preprocessed data."""
+        new = copy(self)
+        new.tree = deepcopy(self.tree, memo)
+        new.tree.getroot().document = new
+        new.base_meta = deepcopy(self.base_meta, memo)
+        new.ids = deepcopy(self.ids, memo)
+        new.prepared = None
+        new.prepare_lock = threading.Lock()
+        new.frozen = False
+        new.parts = {}
+        new.parts_lock = threading.Lock()
+        return new
+
+    def freeze(self):
+        """
+        Makes the document read-only, so that it can be shared by threads.
 
-        self.tree.getroot().validate()
+        The document and all its parts are loaded and prepared first,
+        and the parts are frozen as well. After that, any method which would
+        modify the tree raises DocumentFrozen, and so do builders which
+        modify the document (see `modifies_document`); `build` and
+        `build_many` give those a copy. Per-build data is kept by builders.
+
+        The flag is only checked by librarian's own code: the lxml tree
+        itself stays mutable, and code changing it directly has to check
+        `frozen` on its own.
+        """
+        if self.frozen:
+            return
+        self.prepare()
+        self.frozen = True
+        self.preload_parts()
+        for part in list(self.parts.values()):
+            if isinstance(part, WLDocument):
+                part.freeze()
+
+    def check_not_frozen(self):
+        if self.frozen:
+            raise DocumentFrozen("Document is frozen and can't be modified.")
 
     @property
     def meta(self):
@@ -36,85 +206,387 @@ class WLDocument:
     @property
     def children(self):
         for part_uri in self.meta.parts or []:
-            with self.provider.by_slug(part_uri.slug) as f:
-                try:
-                    yield type(self)(filename=f, provider=self.provider)
-                except Exception as e:
+            yield self.get_part(part_uri.slug)
 
-                    yield e
+    def get_part(self, slug):
+        """
+        Returns the document of a part, loading it only once.
 
-    def build(self, builder, base_url=None, **kwargs):
-        return builder(base_url=base_url).build(self, **kwargs)
+        If the part couldn't be parsed, the error is returned instead.
+        Errors from the provider are raised, and not remembered.
+        """
+        with self.parts_lock:
+            if slug in self.parts:
+                return self.parts[slug]
+        with self.provider.by_slug(slug) as f:
+            try:
+                part = type(self)(filename=f, provider=self.provider)
+            except Exception as e:
+                part = e
+        with self.parts_lock:
+            part = self.parts.setdefault(slug, part)
+        if self.frozen and isinstance(part, WLDocument):
+            part.freeze()
+        return part
 
-    def assign_ids(self, existing=None):
-        # Find all existing IDs.
-        existing = existing or set()
-        que = [self.tree.getroot()]
-        while que:
-            item = que.pop(0)
+    def preload_parts(self, parallel=None):
+        """
+        Loads the whole tree of parts, level by level.
+
+        With `parallel`, parts on each level are loaded concurrently by
+        that many threads. Parts the provider fails to give are left out,
+        so that the error is raised when they're actually used.
+        """
+        def load(item):
+            document, slug = item
             try:
-                item.normalize_insides()
-            except AttributeError:
-                pass
-            existing.add(item.attrib.get('id'))
-            que.extend(item)
-
-        i = 1
-        que = [self.tree.getroot()]
-        while que:
-            item = que.pop(0)
-            que.extend(item)
-            if item.attrib.get('id'):
+                return document.get_part(slug)
+            except Exception:
+                return None
+
+        executor = ThreadPoolExecutor(max_workers=parallel) if parallel else None
+        seen = set()
+        try:
+            level = [self]
+            while level:
+                items = []
+                for document in level:
+                    for part_uri in document.meta.parts or []:
+                        # Don't loop forever on cyclic parts.
+                        if part_uri.slug not in seen:
+                            seen.add(part_uri.slug)
+                            items.append((document, part_uri.slug))
+                if executor is not None:
+                    parts = executor.map(load, items)
+                else:
+                    parts = map(load, items)
+                level = [part for part in parts if isinstance(part, WLDocument)]
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def build(self, builder, base_url=None, **kwargs):
+        document = self
+        if self.frozen and getattr(builder, 'modifies_document', False):
+            document = deepcopy(self)
+        return builder(base_url=base_url).build(document, **kwargs)
+
+    def build_many(self, builders, base_url=None, workers=None, **kwargs):
+        """
+        Builds several outputs from this document, parsed and prepared once.
+
+        `builders` maps names to builder classes, the result maps the same
+        names to OutputFiles. Builders which modify the document while
+        building (see `modifies_document`) work on their own copies.
+        With `workers`, the builds run on a thread pool of that size.
+        """
+        self.prepare()
+        jobs = {}
+        for name, builder in builders.items():
+            document = self
+            if getattr(builder, 'modifies_document', False):
+                document = deepcopy(self)
+            jobs[name] = (document, builder)
+
+        def build(job):
+            document, builder = job
+            return document.build(builder, base_url=base_url, **kwargs)
+
+        if not workers:
+            return {name: build(job) for name, job in jobs.items()}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                name: executor.submit(build, job)
+                for name, job in jobs.items()
+            }
+        return {name: future.result() for name, future in futures.items()}
+
+    def prepare(self, force=False):
+        """
+        Runs the preprocessing needed by builders, in one pass over the tree.
+
+        Computes the ordered ids, section ids, verse splits, the context
+        (meta, settings) of every element and finds elements missing an id.
+        The result is cached on the document, so builders run on the same
+        document only pay for it once. Elements prepare the document on
+        first use of their meta, ids or context.
+        Librarian's methods modifying the tree drop the cached result;
+        use `force` after modifying the tree in other ways.
+        """
+        if self.prepared is not None and not force:
+            return self.prepared
+        with self.prepare_lock:
+            if self.prepared is not None and not force:
+                return self.prepared
+            self.check_not_frozen()
+            return self._prepare()
+
+    def _prepare(self):
+        prepared = Preparation(self)
+        ordered_ids = prepared.ordered_ids
+        section_ids = prepared.section_ids
+        contexts = prepared.contexts
+        ids = self.ids
+        root = self.tree.getroot()
+        master = getattr(root, 'master', None)
+        split = self.LINE_SWAP_EXPR.split
+
+        meta_objects = prepared.meta_objects
+        for rdf in root.iter(RDFNS('RDF')):
+            owner = rdf.getparent()
+            if owner is not None and owner not in meta_objects:
+                meta_objects[owner] = dcparser.BookInfo.from_element(rdf)
+        class_settings = {}
+
+        order = 4
+        missing = []
+        stanzas = []
+
+        # Frame: element, its children, section prefix for the children,
+        # whether children get ordered ids, whether it's a numbered stanza,
+        # depth, context for the children.
+        stack = [(
+            None, iter([(0, root)]), None, True, False, 0,
+            ElementContext(prepared.get_own_meta(root) or self.base_meta)
+        )]
+        while stack:
+            frame = stack[-1]
+            for index, elem in frame[1]:
+                break
+            else:
+                stack.pop()
+                elem = frame[0]
+                # Line breaks in stanza count as elements in ordered ids.
+                if stack and stack[-1][4] and elem.tail:
+                    order += len(split(elem.tail)) - 1
                 continue
-            if not getattr(item, 'SHOULD_HAVE_ID', False):
+
+            _parent, _children, prefix, numbered, _stanza, depth, context = frame
+            is_element = isinstance(elem.tag, str)
+
+            child_prefix = None
+            if prefix is not None:
+                section_id = prefix + str(index + 1)
+                child_prefix = section_id + '-'
+                if is_element:
+                    section_ids[elem] = section_id
+            if elem is master:
+                child_prefix = 'sec'
+
+            child_numbered = child_stanza = False
+            if is_element:
+                if numbered:
+                    ordered_ids[elem] = order
+                    order += 1
+                    if getattr(elem, 'HTML_CLASS', None) == 'stanza':
+                        child_numbered = child_stanza = True
+                        if elem.text:
+                            order += len(split(elem.text)) - 1
+                    else:
+                        child_numbered = elem.tag not in ('uwaga', 'extra')
+
+                elem_id = elem.get('id')
+                if elem_id:
+                    ids.add(elem_id)
+                elif getattr(elem, 'SHOULD_HAVE_ID', False):
+                    missing.append((depth, elem))
+
+                if hasattr(elem, 'split_verses'):
+                    stanzas.append(elem)
+
+                cls = type(elem)
+                settings = class_settings.get(cls)
+                if settings is None:
+                    settings = class_settings[cls] = tuple(
+                        setting for setting in CONTEXT_SETTINGS
+                        if hasattr(cls, setting)
+                    )
+                meta = prepared.get_own_meta(elem)
+                if settings or meta is not None:
+                    context = context.derive(elem, meta, settings)
+                contexts[elem] = context
+
+            stack.append((
+                elem, enumerate(elem), child_prefix,
+                child_numbered, child_stanza, depth + 1, context
+            ))
+
+        # Stable sort by depth gives breadth-first order.
+        missing.sort(key=itemgetter(0))
+        prepared.missing_ids = [elem for depth, elem in missing]
+
+        # Split only after all the stanza's descendants are known,
+        # so that the copies can share their prepared values.
+        for stanza in stanzas:
+            prepared.verses[stanza] = list(stanza.split_verses(prepared))
+
+        self.prepared = prepared
+        return prepared
+
+    def dump_prepared(self):
+        """
+        Serializes the document along with its preprocessed data.
+
+        Elements are referred to by their position in document order.
+        Load the result with `from_prepared`.
+        """
+        prepared = self.prepare()
+        elements = list(self.tree.getroot().iter())
+        positions = {element: i for i, element in enumerate(elements)}
+
+        meta_positions = {}
+        meta = []
+        for owner, meta_object in prepared.meta_objects.items():
+            meta_positions[id(meta_object)] = positions[owner]
+            meta.append((positions[owner], meta_object))
+
+        # Contexts are shared, so each one is stored once.
+        context_indices = {}
+        contexts = []
+        element_contexts = []
+        for element, context in prepared.contexts.items():
+            if element not in positions:
+                # Verse splits are made again on loading.
                 continue
-            while f'e{i}' in existing:
-                i += 1
-            item.attrib['id'] = f'e{i}'
-            i += 1
+            index = context_indices.get(id(context))
+            if index is None:
+                index = context_indices[id(context)] = len(contexts)
+                contexts.append((
+                    meta_positions.get(id(context.meta)),
+                    {
+                        setting: positions[owner]
+                        for setting, owner in context.owners.items()
+                    }
+                ))
+            element_contexts.append((positions[element], index))
+
+        return pickle.dumps({
+            'xml': etree.tostring(self.tree, encoding='utf-8'),
+            'ids': self.ids,
+            'meta': meta,
+            'contexts': contexts,
+            'element_contexts': element_contexts,
+            'ordered_ids': [
+                (positions[element], value)
+                for element, value in prepared.ordered_ids.items()
+                if element in positions
+            ],
+            'section_ids': [
+                (positions[element], value)
+                for element, value in prepared.section_ids.items()
+                if element in positions
+            ],
+            'missing_ids': [
+                positions[element] for element in prepared.missing_ids
+            ],
+            'stanzas': [positions[stanza] for stanza in prepared.verses],
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_prepared(cls, data, provider=None):
+        """
+        Loads a document serialized with `dump_prepared`.
+
+        The tree is parsed from its serialized form, but not validated
+        or preprocessed again, apart from splitting the verses.
+        Only load data from a trusted source.
+        """
+        record = pickle.loads(data)
+        tree = etree.fromstring(record['xml'], parser=get_parser()).getroottree()
+        document = cls(provider=provider, tree=tree)
+        document.ids = record['ids']
+
+        prepared = Preparation(document)
+        elements = list(tree.getroot().iter())
+        meta_objects = prepared.meta_objects
+        meta_by_position = {}
+        for position, meta_object in record['meta']:
+            meta_objects[elements[position]] = meta_object
+            meta_by_position[position] = meta_object
+        contexts = [
+            ElementContext(
+                document.base_meta if meta is None else meta_by_position[meta],
+                {
+                    setting: elements[position]
+                    for setting, position in owners.items()
+                }
+            )
+            for meta, owners in record['contexts']
+        ]
+        for position, index in record['element_contexts']:
+            prepared.contexts[elements[position]] = contexts[index]
+        for position, value in record['ordered_ids']:
+            prepared.ordered_ids[elements[position]] = value
+        for position, value in record['section_ids']:
+            prepared.section_ids[elements[position]] = value
+        prepared.missing_ids = [
+            elements[position] for position in record['missing_ids']
+        ]
+        for position in record['stanzas']:
+            stanza = elements[position]
+            prepared.verses[stanza] = list(stanza.split_verses(prepared))
+
+        document.prepared = prepared
+        return document
+
+    def assign_ids(self, existing=None):
+        """
+        Gives an `e{N}` id to every element which should have one.
+
+        Elements are given ids in breadth-first order. All ids already
+        present in the document are kept in `self.ids`, so that new ids
+        can be handed out later without rescanning.
+        """
+        self.check_not_frozen()
+        if existing:
+            self.ids.update(existing)
+        missing = self.prepare().missing_ids
+        for item in missing:
+            item.attrib['id'] = self.ids.next_id()
+        if missing:
+            # Verse splits now lack the new ids.
+            self.prepared = None
+
+    def new_id(self, element=None):
+        """
+        Returns an id not yet used in the document.
+
+        If an element is given, the id is assigned to it.
+        The document is prepared first, so that the existing ids are known.
+        """
+        self.check_not_frozen()
+        self.prepare()
+        new_id = self.ids.next_id()
+        if element is not None:
+            element.attrib['id'] = new_id
+            # Verse splits may lack the new id.
+            self.prepared = None
+        return new_id
 
     def _compat_assign_ordered_ids(self):
         """
         Compatibility: ids in document order, to be roughly compatible with legacy
         footnote ids. Just for testing consistency, change to some sane identifiers
         at convenience.
-        """
-        EXPR = re.compile(r'/\s', re.MULTILINE | re.UNICODE)
-        def _compat_assign_ordered_ids_in_elem(elem, i):
-            if isinstance(elem, etree._Comment): return i
-            elem.attrib['_compat_ordered_id'] = str(i)
-            i += 1
-            if getattr(elem, 'HTML_CLASS', None) == 'stanza':
-                if elem.text:
-                    i += len(EXPR.split(elem.text)) - 1
-                for sub in elem:
-                    i = _compat_assign_ordered_ids_in_elem(sub, i)
-                    if sub.tail:
-                        i += len(EXPR.split(sub.tail)) - 1
-            else:
-                if elem.tag in ('uwaga', 'extra'):
-                    return i
-                for sub in elem:
-                    i = _compat_assign_ordered_ids_in_elem(sub, i)
-            return i
 
-        _compat_assign_ordered_ids_in_elem(self.tree.getroot(), 4)
+        Builders use the values from `prepare` directly, this only
+        stores them as `_compat_ordered_id` attributes.
+        """
+        self.check_not_frozen()
+        for elem, value in self.prepare().ordered_ids.items():
+            elem.attrib['_compat_ordered_id'] = str(value)
 
     def _compat_assign_section_ids(self):
         """
         Ids in master-section order. These need to be compatible with the
         #secN anchors used by WL search results page to link to fragments.
-        """
-        def _compat_assigns_section_ids_in_elem(elem, prefix='sec'):
-            for i, child in enumerate(elem):
-                idfier = '{}{}'.format(prefix, i + 1)
-                try:
-                    child.attrib['_compat_section_id'] = idfier
-                except:
-                    pass
-                _compat_assigns_section_ids_in_elem(child, idfier + '-')
-        _compat_assigns_section_ids_in_elem(self.tree.getroot().master)
 
+        Builders use the values from `prepare` directly, this only
+        stores them as `_compat_section_id` attributes.
+        """
+        self.check_not_frozen()
+        for elem, value in self.prepare().section_ids.items():
+            elem.attrib['_compat_section_id'] = value
 
     def editors(self):
         persons = set(self.meta.editors
@@ -188,3 +660,85 @@ class WLDocument:
                     data['total'][k] = data['total'].get(k, 0) + v
 
         return data
+
+
+_source_hash = None
+
+
+def get_source_hash():
+    """Returns a hash of librarian's own Python code."""
+    global _source_hash
+    if _source_hash is None:
+        h = hashlib.sha256()
+        root = os.path.dirname(os.path.abspath(__file__))
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    path = os.path.join(dirpath, filename)
+                    h.update(os.path.relpath(path, root).encode('utf-8'))
+                    with open(path, 'rb') as f:
+                        h.update(f.read())
+        _source_hash = h.hexdigest()
+    return _source_hash
+
+
+def get_librarian_version():
+    """
+    Returns the installed version of librarian, along with a hash of its
+    code, so that it changes in development checkouts too.
+    """
+    try:
+        installed = version('librarian')
+    except PackageNotFoundError:
+        installed = 'unknown'
+    return '%s+%s' % (installed, get_source_hash()[:16])
+
+
+class DocumentCache:
+    """
+    Keeps prepared documents in a directory, for `WLDocument.from_prepared`.
+
+    Entries are keyed by a hash of the source and the librarian version,
+    so they never need to be invalidated; old entries can just be removed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.version = get_librarian_version()
+
+    def get_key(self, data):
+        return hashlib.sha256(
+            self.version.encode('utf-8') + b'\0' + data
+        ).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    def load(self, data, provider=None):
+        """
+        Returns a prepared document for the source given as bytes.
+
+        On a miss, the document is parsed, prepared and stored.
+        """
+        path = self.get_path(self.get_key(data))
+        try:
+            with open(path, 'rb') as f:
+                return WLDocument.from_prepared(f.read(), provider=provider)
+        except Exception:
+            # A missing, corrupt or truncated entry is a miss.
+            pass
+
+        document = WLDocument(filename=io.BytesIO(data), provider=provider)
+        # Write atomically, so that concurrent workers never see a partial entry.
+        f = tempfile.NamedTemporaryFile(
+            dir=self.path, suffix='.tmp', delete=False)
+        try:
+            with f:
+                f.write(document.dump_prepared())
+            os.replace(f.name, path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+        return document
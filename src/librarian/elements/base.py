@@ -2,10 +2,14 @@
 # Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
 #
 import copy
-import re
 from lxml import etree
 from librarian import dcparser, RDFNS
-from librarian.util import get_translation
+from librarian.util import get_normalizer, get_translation
+
+
+# Settings which elements inherit from their ancestors, see in_context_of.
+CONTEXT_SETTINGS = ('NO_TOC', 'START_INLINE')
+
 
 def last_words(text, n):
     words = []
@@ -20,6 +24,55 @@ def last_words(text, n):
         return n, ' '.join(reversed(words))
 
 
+# Builder attributes which may decide what's pruned, along with the
+# builder class and the build method. They're read from the builder
+# instance, so they can be set per build.
+PRUNING_OPTIONS = ('with_themes',)
+
+
+class DispatchTable(dict):
+    """
+    Maps element classes to the methods building them with a builder class
+    and the builder's PRUNING_OPTIONS.
+
+    Elements which aren't WLElements, or which the builder never renders
+    (see WLElement.is_pruned), map to None and are skipped with their
+    whole subtree.
+    """
+
+    def __init__(self, builder_class, build_method, options):
+        self.builder_class = builder_class
+        self.build_method = build_method
+        self.options = options
+
+    def __missing__(self, cls):
+        if (issubclass(cls, WLElement)
+                and not cls.is_pruned(
+                    self.builder_class, self.build_method, self.options)):
+            handler = getattr(cls, self.build_method)
+        else:
+            handler = None
+        self[cls] = handler
+        return handler
+
+
+_dispatch_tables = {}
+
+
+def get_dispatch_table(builder, build_method):
+    options = tuple(getattr(builder, name, None) for name in PRUNING_OPTIONS)
+    key = type(builder), build_method, options
+    try:
+        return _dispatch_tables[key]
+    except KeyError:
+        return _dispatch_tables.setdefault(
+            key, DispatchTable(
+                type(builder), build_method,
+                dict(zip(PRUNING_OPTIONS, options))
+            )
+        )
+
+
 class WLElement(etree.ElementBase):
     SECTION_PRECEDENCE = None
     ASIDE = False
@@ -52,8 +105,53 @@ class WLElement(etree.ElementBase):
         ("'", "\u2019"),    # This was enabled for epub.
     ]
 
+    @classmethod
+    def is_pruned(cls, builder_class, build_method, options):
+        """
+        Tells if elements of this class are never rendered by the builder.
+
+        `options` has the values of PRUNING_OPTIONS on the builder instance.
+        Pruned elements are skipped by the parent, along with their subtree.
+        """
+        return False
+
+    def get_document(self):
+        """Returns the WLDocument this element belongs to, if any."""
+        return getattr(self.getroottree().getroot(), 'document', None)
+
+    def get_prepared(self):
+        """
+        Returns the preprocessed data of the document, if any.
+
+        The document is prepared on first use.
+        """
+        document = self.get_document()
+        if document is not None:
+            return document.prepare()
+
+    def get_ordered_id(self):
+        prepared = self.get_prepared()
+        if prepared is not None and self in prepared.ordered_ids:
+            return prepared.ordered_ids[self]
+        return self.attrib.get('_compat_ordered_id')
+
+    def get_section_id(self):
+        prepared = self.get_prepared()
+        if prepared is not None and self in prepared.section_ids:
+            return prepared.section_ids[self]
+        return self.attrib.get('_compat_section_id')
+
+    def get_context(self):
+        """Returns the ElementContext of this element, if prepared."""
+        prepared = self.get_prepared()
+        if prepared is not None:
+            return prepared.contexts.get(self)
+
     @property
     def meta_object(self):
+        prepared = self.get_prepared()
+        if prepared is not None:
+            return prepared.meta_objects.get(self)
         if not hasattr(self, '_meta_object'):
             elem = self.find(RDFNS('RDF'))
             if elem is not None:
@@ -64,6 +162,9 @@ class WLElement(etree.ElementBase):
 
     @property
     def meta(self):
+        context = self.get_context()
+        if context is not None:
+            return context.meta
         if self.meta_object is not None:
             return self.meta_object
         else:
@@ -74,21 +175,44 @@ class WLElement(etree.ElementBase):
 
     @property
     def gettext(self):
+        context = self.get_context()
+        if context is not None:
+            return context.translation.gettext
         return get_translation(self.meta.language).gettext
 
-    def in_context_of(self, setting):
+    def get_setting_owner(self, setting):
+        """Returns the closest ancestor defining the setting."""
         parent = self.getparent()
         if parent is None:
+            return None
+        if setting in CONTEXT_SETTINGS:
+            context = parent.get_context()
+            if context is not None:
+                return context.owners.get(setting)
+        if hasattr(parent, setting):
+            return parent
+        return parent.get_setting_owner(setting)
+
+    def in_context_of(self, setting, builder=None):
+        """
+        Returns the value of the setting from the closest ancestor.
+
+        Values changed by signals during a build are kept by the builder.
+        """
+        owner = self.get_setting_owner(setting)
+        if owner is None:
             return False
-        try:
-            return getattr(parent, setting)
-        except AttributeError:
-            return parent.in_context_of(setting)
-
-    def signal(self, signal):
+        if builder is not None:
+            try:
+                return builder.element_settings[owner, setting]
+            except (AttributeError, KeyError):
+                pass
+        return getattr(owner, setting)
+
+    def signal(self, signal, builder):
         parent = self.getparent()
         if parent is not None:
-            parent.signal(signal)
+            parent.signal(signal, builder)
     
     def raw_printable_text(self, builder):
         from librarian.html import raw_printable_text
@@ -105,42 +229,34 @@ class WLElement(etree.ElementBase):
         return t
     
     def normalize_text(self, text, builder):
-        text = text or ''
-        for e, s in self.text_substitutions:
-            text = text.replace(e, s)
-            # FIXME: TEmporary turnoff
-#        text = re.sub(r'\s+', ' ', text)
-### TODO: Added now for epub
-
-        if getattr(builder, 'hyphenator', None) is not None:
-            newt = ''
-            wlist = re.compile(r'\w+|[^\w]', re.UNICODE).findall(text)
-            for w in wlist:
-                newt += builder.hyphenator.inserted(w, '\u00AD')
-            text = newt
-
-        if builder.orphans:
-            text = re.sub(r'(?<=\s\w)\s+', '\u00A0', text)
-
-        return text
-
-    def _build_inner(self, builder, build_method):
+        return get_normalizer(builder, self.text_substitutions)(text or '')
+
+    def _build_inner(self, builder, build_method, can_have_text=None, strip=None):
+        if can_have_text is None:
+            can_have_text = self.CAN_HAVE_TEXT
+        if strip is None:
+            strip = self.STRIP
         child_count = len(self)
-        if self.CAN_HAVE_TEXT and self.text:
+        if can_have_text and self.text:
             text = self.normalize_text(self.text, builder)
-            if self.STRIP:
+            if strip:
                 text = text.lstrip()
                 if not child_count:
                     text = text.rstrip()
             builder.push_text(text)
+        if not child_count:
+            return
+        dispatch = get_dispatch_table(builder, build_method)
+        debug = getattr(builder, 'debug', False)
         for i, child in enumerate(self):
-            if isinstance(child, WLElement):
-                getattr(child, build_method)(builder)
-            elif getattr(builder, 'debug', False) and child.tag is etree.Comment:
+            handler = dispatch[child.__class__]
+            if handler is not None:
+                handler(child, builder)
+            elif debug and child.tag is etree.Comment:
                 builder.process_comment(child)
-            if self.CAN_HAVE_TEXT and child.tail:
+            if can_have_text and child.tail:
                 text = self.normalize_text(child.tail, builder)
-                if self.STRIP and i == child_count - 1:
+                if strip and i == child_count - 1:
                     text = text.rstrip()
                 builder.push_text(text)
 
@@ -170,8 +286,10 @@ class WLElement(etree.ElementBase):
         # always copy the id attribute (?)
         if self.attrib.get('id'):
             attr['id'] = self.attrib['id']
-        elif getattr(self, 'SHOULD_HAVE_ID', False) and '_compat_section_id' in self.attrib:
-            attr['id'] = self.attrib['_compat_section_id']
+        elif getattr(self, 'SHOULD_HAVE_ID', False):
+            section_id = self.get_section_id()
+            if section_id is not None:
+                attr['id'] = section_id
         return attr
 
     def html_build(self, builder):
@@ -186,7 +304,13 @@ class WLElement(etree.ElementBase):
             builder.end_element()
 
     def _epub_build_inner(self, builder):
-        self._build_inner(builder, 'epub_build')
+        # TEMPORARY: text is kept as-is everywhere in EPUB.
+        self._build_inner(
+            builder, 'epub_build', can_have_text=True, strip=False
+        )
+
+    def get_epub_tag(self, builder):
+        return self.EPUB_TAG
 
     def get_epub_attr(self, builder):
         attr = self.EPUB_ATTR.copy()
@@ -197,10 +321,6 @@ class WLElement(etree.ElementBase):
     def epub_build(self, builder):
         from librarian.elements.masters import Master
 
-        # TEMPORARY
-        self.CAN_HAVE_TEXT = True
-        self.STRIP = False
-
         start_chunk = self.EPUB_START_CHUNK and isinstance(self.getparent(), Master)
 
         if start_chunk:
@@ -210,7 +330,6 @@ class WLElement(etree.ElementBase):
         if self.SECTION_PRECEDENCE and not self.in_context_of('NO_TOC'):
             if not start_chunk:
                 fragment = 'sub%d' % builder.assign_section_number()
-                self.attrib['id'] = fragment
 
             builder.add_toc_entry(
                 fragment,
@@ -218,7 +337,8 @@ class WLElement(etree.ElementBase):
                 self.SECTION_PRECEDENCE
             )
             
-        if self.EPUB_TAG:
+        epub_tag = self.get_epub_tag(builder)
+        if epub_tag:
             attr = self.get_epub_attr(builder)
             if fragment:
                 attr['id'] = fragment
@@ -228,12 +348,12 @@ class WLElement(etree.ElementBase):
                     chunkno, sourceline = len(builder.splits), sourceline - builder.splits[-1]
                 attr['data-debug'] = f'{chunkno}:{sourceline}'
             builder.start_element(
-                self.EPUB_TAG,
+                epub_tag,
                 attr
             )
 
         self._epub_build_inner(builder)
-        if self.EPUB_TAG:
+        if epub_tag:
             builder.end_element()
 
     def validate(self):
@@ -295,7 +415,8 @@ class WLElement(etree.ElementBase):
         return words, snippet
 
     def get_snippet(self, words=15):
-        from librarian.parser import parser
+        from librarian.parser import get_parser
+        parser = get_parser()
 
         words, snippet = self.getparent().snip(words=words, before=self)
         
@@ -317,7 +438,7 @@ class WLElement(etree.ElementBase):
         return snipelem
 
     def get_link(self):
-        sec = getattr(self, 'SHOULD_HAVE_ID', False) and self.attrib.get('_compat_section_id')
+        sec = getattr(self, 'SHOULD_HAVE_ID', False) and self.get_section_id()
         if sec:
             return sec
         parent_index = self.getparent().index(self)
@@ -5,6 +5,10 @@ from ..base import WLElement
 
 
 class Abstrakt(WLElement):
+    @classmethod
+    def is_pruned(cls, builder_class, build_method, options):
+        return True
+
     def txt_build(self, builder):
         pass
 
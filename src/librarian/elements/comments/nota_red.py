@@ -5,6 +5,10 @@ from ..base import WLElement
 
 
 class NotaRed(WLElement):
+    @classmethod
+    def is_pruned(cls, builder_class, build_method, options):
+        return build_method != 'html_build'
+
     def txt_build(self, builder):
         pass
 
@@ -9,11 +9,11 @@ class Footnote(WLElement):
     START_INLINE = True
     ASIDE = True
 
-    def signal(self, signal):
+    def signal(self, signal, builder):
         if signal == 'INLINE':
-            self.START_INLINE = False
+            builder.element_settings[self, 'START_INLINE'] = False
         else:
-            super().signal(signal)
+            super().signal(signal, builder)
     
     def txt_build(self, builder):
         pass
@@ -24,8 +24,9 @@ class Footnote(WLElement):
 
         builder.footnote_counter += 1
         fn_no = builder.footnote_counter
-        footnote_id = 'footnote-idm{}'.format(self.attrib['_compat_ordered_id'])
-        anchor_id = 'anchor-idm{}'.format(self.attrib['_compat_ordered_id'])
+        ordered_id = self.get_ordered_id()
+        footnote_id = 'footnote-idm{}'.format(ordered_id)
+        anchor_id = 'anchor-idm{}'.format(ordered_id)
 
         # Add anchor.
         builder.start_element(
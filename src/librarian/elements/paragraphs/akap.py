@@ -13,18 +13,12 @@ class Akap(WLElement):
     TXT_LEGACY_TOP_MARGIN = 2
     TXT_LEGACY_BOTTOM_MARGIN = 0
 
-    HTML_TAG = 'p'
+    EPUB_TAG = HTML_TAG = 'p'
     EPUB_CLASS = HTML_CLASS = 'paragraph'
 
-    @property
-    def EPUB_TAG(self):
-        try:
-            return self._set_EPUB_TAG
-        except AttributeError:
-            if self.in_context_of('START_INLINE'):
-                self.signal('INLINE')
-                self._set_EPUB_TAG = None
-            else:
-                self._set_EPUB_TAG = 'p'
-            return self._set_EPUB_TAG
+    def get_epub_tag(self, builder):
+        if self.in_context_of('START_INLINE', builder):
+            self.signal('INLINE', builder)
+            return None
+        return self.EPUB_TAG
  
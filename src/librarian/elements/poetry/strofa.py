@@ -3,7 +3,7 @@
 #
 from copy import copy
 import re
-from ..base import WLElement
+from ..base import WLElement, get_dispatch_table
 from .wers import Wers
 
 
@@ -30,7 +30,25 @@ class Strofa(WLElement):
         builder.end_element()
     
     def get_verses(self):
-        from librarian.parser import parser
+        prepared = self.get_prepared()
+        if prepared is not None and self in prepared.verses:
+            return prepared.verses[self]
+        return self.split_verses()
+
+    def split_verses(self, prepared=None):
+        """
+        Splits the stanza into verses on slashes.
+
+        Children are copied, never moved, so the tree is left intact.
+        """
+        from librarian.parser import get_parser
+        parser = get_parser()
+
+        def copy_child(child):
+            child_copy = copy(child)
+            if prepared is not None:
+                prepared.register_copy(child, child_copy)
+            return child_copy
 
         verses = [
             parser.makeelement('wers')
@@ -46,7 +64,7 @@ class Strofa(WLElement):
         for child in self:
             if child.tail:
                 pieces = re.split(r"/\s+", child.tail)
-                child_copy = copy(child)
+                child_copy = copy_child(child)
                 child_copy.tail = pieces[0]
                 verses[-1].append(child_copy)
 
@@ -55,10 +73,12 @@ class Strofa(WLElement):
                     verses[-1].text = piece
                 
             else:
-                verses[-1].append(child)
+                verses[-1].append(copy_child(child))
 
         for verse in verses:
             verse.stanza = self
+            if prepared is not None:
+                prepared.register_verse(verse, self)
             if len(verse) == 1 and isinstance(verse[0], Wers):
                 assert not (verse.text or '').strip()
                 assert not (verse[0].tail or '').strip()
@@ -66,6 +86,9 @@ class Strofa(WLElement):
             else:
                 yield verse
 
-    def _build_inner(self, builder, build_method):
+    def _build_inner(self, builder, build_method, **kwargs):
+        dispatch = get_dispatch_table(builder, build_method)
         for child in self.get_verses():
-            getattr(child, build_method)(builder)
+            handler = dispatch[child.__class__]
+            if handler is not None:
+                handler(child, builder)
@@ -17,6 +17,9 @@ class Wers(WLElement):
 
     @property
     def meta(self):
+        context = self.get_context()
+        if context is not None:
+            return context.meta
         if hasattr(self, 'stanza'):
             return self.stanza.meta
         return super(Wers, self).meta
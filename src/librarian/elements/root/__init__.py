@@ -10,6 +10,9 @@ class Utwor(WLElement):
 
     @property
     def meta(self):
+        context = self.get_context()
+        if context is not None:
+            return context.meta
         if self.meta_object is not None:
             return self.meta_object
         else:
@@ -8,6 +8,13 @@ class Motyw(WLElement):
     ASIDE = True
     HTML_TAG = "a"
 
+    @classmethod
+    def is_pruned(cls, builder_class, build_method, options):
+        return (
+            build_method != 'html_build'
+            or not options['with_themes']
+        )
+
     def txt_build(self, builder):
         pass
 
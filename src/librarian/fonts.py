@@ -1,21 +1,155 @@
 # This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
 # Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
 #
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import io
 import os
-from shutil import rmtree
-from tempfile import mkdtemp
-from fontTools.subset import main
-
-
-def strip_font(path, chars):
-    tmpdir = mkdtemp('-librarian-epub')
-    main([
-        path,
-       '--text=' + ''.join(chars),
-       '--output-file=' + os.path.join(tmpdir, 'font.ttf')
-    ])
-    with open(os.path.join(tmpdir, 'font.ttf'), 'rb') as f:
-        content = f.read()
-
-    rmtree(tmpdir)
-    return content
+import threading
+from fontTools import subset
+
+
+# Max number of subset fonts kept in memory.
+SUBSET_CACHE_SIZE = 64
+
+# fontTools flavors and media types of the output font formats.
+FORMATS = {
+    'ttf': (None, 'font/ttf'),
+    'woff': ('woff', 'font/woff'),
+    'woff2': ('woff2', 'font/woff2'),
+}
+
+# Font file contents, by path.
+font_data = {}
+# Subset fonts, by (path, frozenset of chars, format),
+# least recently used first.
+subsets = OrderedDict()
+# Process pools for subsetting, by number of workers, shared between calls.
+executors = {}
+lock = threading.Lock()
+
+
+def get_font_data(path):
+    data = font_data.get(path)
+    if data is None:
+        with open(path, 'rb') as f:
+            data = font_data[path] = f.read()
+    return data
+
+
+def check_format(font_format):
+    """Raises an error if fonts can't be saved in the given format."""
+    if font_format not in FORMATS:
+        raise ValueError('Unknown font format: %s' % font_format)
+    if font_format == 'woff2':
+        from fontTools.ttLib import woff2
+        if not woff2.haveBrotli:
+            raise ImportError('WOFF2 fonts require the brotli package.')
+
+
+def get_file_name(path, font_format):
+    """Returns the font's file name, with extension for the format."""
+    return os.path.splitext(os.path.basename(path))[0] + '.' + font_format
+
+
+def get_executor(workers=None):
+    """Returns the shared pool of `workers` processes (one per CPU by default)."""
+    with lock:
+        executor = executors.get(workers)
+        if executor is None:
+            executor = executors[workers] = ProcessPoolExecutor(
+                max_workers=workers)
+    return executor
+
+
+def subset_font(path, text, font_format='ttf'):
+    """Subsets the font to the characters in text, with fontTools defaults."""
+    options = subset.Options()
+    options.flavor = FORMATS[font_format][0]
+    font = subset.load_font(
+        io.BytesIO(get_font_data(path)), options, dontLoadGlyphNames=True)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(text=text)
+    subsetter.subset(font)
+    output = io.BytesIO()
+    subset.save_font(font, output, options)
+    return output.getvalue()
+
+
+def strip_fonts(paths, chars, workers=None, font_format='ttf'):
+    """
+    Returns the contents of the fonts, subset to the given characters
+    and saved in `font_format` (ttf, woff or woff2).
+
+    Results are cached by font, set of characters and format. Fonts not
+    in cache are subset in a shared pool of `workers` processes (one per
+    CPU by default); with `workers=1` they are subset in this process.
+    """
+    check_format(font_format)
+    chars = frozenset(chars)
+    text = ''.join(sorted(chars))
+    results = {}
+    with lock:
+        for path in paths:
+            content = subsets.get((path, chars, font_format))
+            if content is not None:
+                subsets.move_to_end((path, chars, font_format))
+                results[path] = content
+    missing = [path for path in paths if path not in results]
+
+    contents = None
+    if workers != 1 and len(missing) > 1:
+        executor = get_executor(workers)
+        try:
+            contents = list(executor.map(
+                subset_font, missing, [text] * len(missing),
+                [font_format] * len(missing)))
+        except BrokenProcessPool:
+            # A worker died; drop the pool and subset here instead.
+            with lock:
+                if executors.get(workers) is executor:
+                    del executors[workers]
+    if contents is None:
+        contents = [subset_font(path, text, font_format) for path in missing]
+
+    with lock:
+        for path, content in zip(missing, contents):
+            results[path] = subsets[path, chars, font_format] = content
+        while len(subsets) > SUBSET_CACHE_SIZE:
+            subsets.popitem(last=False)
+    return [results[path] for path in paths]
+
+
+def strip_font(path, chars, font_format='ttf'):
+    return strip_fonts([path], chars, font_format=font_format)[0]
+
+
+def get_size_report(paths, chars, formats=None):
+    """
+    Returns the sizes of the subset fonts in each format, as a list of
+    (file name, {format: size}). Formats default to all the available ones.
+    """
+    if formats is None:
+        formats = []
+        for font_format in FORMATS:
+            try:
+                check_format(font_format)
+            except ImportError:
+                continue
+            formats.append(font_format)
+    sizes = {
+        font_format: [
+            len(content)
+            for content in strip_fonts(paths, chars, font_format=font_format)
+        ]
+        for font_format in formats
+    }
+    return [
+        (
+            os.path.basename(path),
+            {font_format: sizes[font_format][i] for font_format in formats}
+        )
+        for i, path in enumerate(paths)
+    ]
+
@@ -291,10 +291,14 @@ def extract_fragments(input_filename):
     return closed_fragments, open_fragments
 
 
-def add_anchor(element, prefix, with_link=True, with_target=True,
-               link_text=None):
-    parent = element.getparent()
-    index = parent.index(element)
+def make_anchor(prefix, with_link=True, with_target=True, link_text=None):
+    """Returns the anchor elements to be put before an element."""
+    anchors = []
+    if with_target:
+        anchor_target = etree.Element('a', name='%s' % prefix)
+        anchor_target.set('class', 'target')
+        anchor_target.text = ' '
+        anchors.append(anchor_target)
 
     if with_link:
         if link_text is None:
@@ -302,13 +306,16 @@ def add_anchor(element, prefix, with_link=True, with_target=True,
         anchor = etree.Element('a', href='#%s' % prefix)
         anchor.set('class', 'anchor')
         anchor.text = str(link_text)
-        parent.insert(index, anchor)
+        anchors.append(anchor)
+    return anchors
 
-    if with_target:
-        anchor_target = etree.Element('a', name='%s' % prefix)
-        anchor_target.set('class', 'target')
-        anchor_target.text = ' '
-        parent.insert(index, anchor_target)
+
+def add_anchor(element, prefix, with_link=True, with_target=True,
+               link_text=None):
+    parent = element.getparent()
+    index = parent.index(element)
+    for anchor in reversed(make_anchor(prefix, with_link, with_target, link_text)):
+        parent.insert(index, anchor)
 
 
 def any_ancestor(element, test):
@@ -357,11 +364,18 @@ def add_anchors(root):
 
 
 def raw_printable_text(element):
-    working = copy.deepcopy(element)
-    for e in working.findall('a'):
-        if e.get('class') in ('annotation', 'theme-begin'):
-            e.text = ''
-    return etree.tostring(working, method='text', encoding='unicode').strip()
+    """Text of the element and its tail, without footnote and theme names."""
+    parts = [element.text or '']
+    for child in element:
+        if child.tag == 'a' and child.get('class') in ('annotation', 'theme-begin'):
+            for grandchild in child:
+                parts.extend(grandchild.itertext())
+                parts.append(grandchild.tail or '')
+        elif isinstance(child.tag, str):
+            parts.extend(child.itertext())
+        parts.append(child.tail or '')
+    parts.append(element.tail or '')
+    return ''.join(parts).strip()
 
 
 def add_table_of_contents(root):
@@ -376,17 +390,29 @@ def add_table_of_contents(root):
                     ) or e.get('class') in ('person-list',)):
                 continue
 
-            element_text = raw_printable_text(element)
-            if (element.tag == 'h3' and len(sections)
-                    and sections[-1][1] == 'h2'):
-                sections[-1][3].append(
-                    (counter, element.tag, element_text, [])
-                )
-            else:
-                sections.append((counter, element.tag, element_text, []))
+            sections.append((counter, element.tag, raw_printable_text(element)))
             add_anchor(element, "s%d" % counter, with_link=False)
             counter += 1
 
+    root.insert(0, make_table_of_contents(sections))
+
+
+def make_table_of_contents(headers):
+    """
+    Builds the table of contents.
+
+    Headers are (number, tag, text) tuples, h3 get nested in preceding h2.
+    """
+    sections = []
+    for counter, tag, element_text in headers:
+        if (tag == 'h3' and len(sections)
+                and sections[-1][1] == 'h2'):
+            sections[-1][3].append(
+                (counter, tag, element_text, [])
+            )
+        else:
+            sections.append((counter, tag, element_text, []))
+
     toc = etree.Element('div')
     toc.set('id', 'toc')
     toc_header = etree.SubElement(toc, 'h2')
@@ -405,10 +431,17 @@ def add_table_of_contents(root):
                 add_anchor(subsection_element, "s%d" % n1, with_target=False,
                            link_text=subtext)
 
-    root.insert(0, toc)
+    return toc
 
 
 def add_table_of_themes(root):
+    root.insert(0, make_table_of_themes(
+        root.findall('.//a[@class="theme-begin"]')
+    ))
+
+
+def make_table_of_themes(fragments):
+    """Builds the list of themes from the theme-begin anchors."""
     try:
         from sortify import sortify
     except ImportError:
@@ -416,7 +449,7 @@ def add_table_of_themes(root):
             return x
 
     book_themes = {}
-    for fragment in root.findall('.//a[@class="theme-begin"]'):
+    for fragment in fragments:
         if not fragment.text:
             continue
         theme_names = [s.strip() for s in fragment.text.split(',')]
@@ -433,7 +466,7 @@ def add_table_of_themes(root):
             item = etree.SubElement(themes_li, 'a', href="#%s" % fragment)
             item.text = str(i + 1)
             item.tail = ' '
-    root.insert(0, themes_div)
+    return themes_div
 
 
 def extract_annotations(html_path):
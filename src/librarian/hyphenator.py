@@ -14,13 +14,32 @@ info@wilbertberendsen.nl
 License: LGPL.
 
 """
+from array import array
+from collections import OrderedDict
+from functools import lru_cache
+import json
+import mmap
+import os
+import hashlib
+import struct
 import sys
 import re
+import tempfile
+import threading
 
 __all__ = ("Hyphenator")
 
-# cache of per-file Hyph_dict objects
-hdcache = {}
+# cache of per-file Hyph_dict objects, least recently used first
+hdcache = OrderedDict()
+hdcache_lock = threading.Lock()
+
+# max number of dictionaries kept in hdcache
+DICT_CACHE_SIZE = 16
+
+# max number of words cached by each dictionary and hyphenator
+CACHE_SIZE = 65536
+
+WORD_RE = re.compile(r'\w+')
 
 # precompile some stuff
 parse_hex = re.compile(r'\^{2}([0-9a-f]{2})').sub
@@ -139,10 +158,283 @@ class Hyph_dict(object):
                         res[s] = map(max, value, res[s])
 
             points = [dint(i - 1, ref=r) for i, r in enumerate(res) if r % 2]
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
+            self.cache[word] = points
+        return points
+
+
+# Compiled dictionaries: header, then the double-array trie
+# (base, check, pattern), the pattern table (start, offset, length),
+# the pattern values and the JSON metadata. Arrays are unsigned 32-bit
+# ints in native byte order; byte order is checked on loading.
+COMPILED_MAGIC = b'WLHYPH1\0'
+COMPILED_HEADER = struct.Struct('=8sIIIII')
+BYTE_ORDER_MARK = 0x01020304
+COMPILED_SUFFIX = '.hyb'
+
+# Where dictionaries without a compiled file next to them are compiled
+# on first use. None turns it off.
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'librarian', 'hyphenation')
+
+
+def get_compiled_name(filename):
+    return os.path.splitext(filename)[0] + COMPILED_SUFFIX
+
+
+def get_cached_name(filename):
+    """Returns the name of the dictionary compiled in CACHE_DIR."""
+    path = os.path.abspath(filename)
+    return os.path.join(CACHE_DIR, '%s-%s%s' % (
+        os.path.splitext(os.path.basename(path))[0],
+        hashlib.sha1(path.encode('utf-8')).hexdigest()[:16],
+        COMPILED_SUFFIX,
+    ))
+
+
+def compile_dict(filename, output=None):
+    """
+    Compiles a hyph_*.dic file into a trie, to be loaded with
+    Compiled_hyph_dict. Returns the output file name.
+    """
+    if output is None:
+        output = get_compiled_name(filename)
+    patterns = Hyph_dict(filename).patterns
+
+    alphabet = ''.join(sorted(set(''.join(patterns))))
+    codes = {c: i + 1 for i, c in enumerate(alphabet)}
+
+    # Build a plain trie first; node 0 is the root.
+    children = [{}]
+    node_patterns = [0]
+    values = []
+    table = []
+    alternatives = {}
+    for tag, (offset, value) in sorted(patterns.items()):
+        node = 0
+        for c in tag:
+            code = codes[c]
+            child = children[node].get(code)
+            if child is None:
+                child = children[node][code] = len(children)
+                children.append({})
+                node_patterns.append(0)
+            node = child
+        for i, v in enumerate(value):
+            if getattr(v, 'data', None):
+                alternatives[len(values) + i] = v.data
+        table.append((len(values), offset, len(value)))
+        values.extend(value)
+        node_patterns[node] = len(table)
+
+    # Lay it out as a double array: child of node n with code c
+    # is at base[n] + c, and check[base[n] + c] == n + 1.
+    position = [0] * len(children)
+    base = array('I')
+    check = array('I', [1])
+    used = bytearray(b'\1')
+    base.append(0)
+    first_free = 1
+    queue = [0]
+    for node in queue:
+        node_codes = sorted(children[node])
+        if not node_codes:
+            continue
+        # Try the free slots for the first child in turn, keeping base >= 1.
+        free = max(first_free, node_codes[0] + 1)
+        while True:
+            found = used.find(0, free)
+            free = max(free, len(used)) if found == -1 else found
+            b = free - node_codes[0]
+            last = b + node_codes[-1]
+            if last >= len(used):
+                used.extend(bytes(last + 1 - len(used)))
+            if not any(used[b + code] for code in node_codes[1:]):
+                break
+            free += 1
+        pos = position[node]
+        while len(base) < len(used):
+            base.append(0)
+            check.append(0)
+        base[pos] = b
+        for code in node_codes:
+            child = children[node][code]
+            used[b + code] = 1
+            check[b + code] = pos + 1
+            position[child] = b + code
+            queue.append(child)
+        first_free = used.find(0, first_free)
+        if first_free == -1:
+            first_free = len(used)
+
+    size = len(used)
+    while len(base) < size:
+        base.append(0)
+        check.append(0)
+    pattern = array('I', bytes(4 * size))
+    for node, index in enumerate(node_patterns):
+        if index:
+            pattern[position[node]] = index
+
+    meta = json.dumps({
+        'alphabet': alphabet,
+        'alternatives': list(alternatives.items()),
+    }).encode('utf-8')
+
+    # Written aside and renamed, so that readers never see a partial file.
+    f = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(os.path.abspath(output)),
+        prefix='.tmp', suffix=COMPILED_SUFFIX, delete=False)
+    try:
+        with f:
+            f.write(COMPILED_HEADER.pack(
+                COMPILED_MAGIC, BYTE_ORDER_MARK, size, len(table),
+                len(values), len(meta)))
+            base.tofile(f)
+            check.tofile(f)
+            pattern.tofile(f)
+            for column in zip(*table):
+                array('I', column).tofile(f)
+            f.write(bytes(int(v) for v in values))
+            f.write(meta)
+        os.replace(f.name, output)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+    return output
+
+
+class Compiled_hyph_dict(object):
+    """
+    Hyphenation patterns compiled with `compile_dict`, used in place
+    through mmap. Gives the same results as Hyph_dict.
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, bom, size, npatterns, nvalues, nmeta = \
+                COMPILED_HEADER.unpack_from(self.mmap)
+        except struct.error:
+            raise ValueError('Truncated compiled dictionary: %s' % filename)
+        if magic != COMPILED_MAGIC or bom != BYTE_ORDER_MARK:
+            raise ValueError('Not a compiled dictionary for this platform: %s'
+                             % filename)
+        if len(self.mmap) != COMPILED_HEADER.size + \
+                4 * (3 * size + 3 * npatterns) + nvalues + nmeta:
+            raise ValueError('Truncated compiled dictionary: %s' % filename)
+        view = memoryview(self.mmap)
+        pos = COMPILED_HEADER.size
+
+        def take(length, fmt='I'):
+            nonlocal pos
+            width = 4 if fmt == 'I' else 1
+            chunk = view[pos:pos + length * width]
+            pos += length * width
+            return chunk.cast(fmt) if fmt == 'I' else chunk
+
+        self.base = take(size)
+        self.check = take(size)
+        self.pattern = take(size)
+        self.pattern_start = take(npatterns)
+        self.pattern_offset = take(npatterns)
+        self.pattern_length = take(npatterns)
+        self.values = take(nvalues, 'B')
+        meta = json.loads(bytes(take(nmeta, 'B')))
+        self.codes = {c: i + 1 for i, c in enumerate(meta['alphabet'])}
+        self.alternatives = {
+            int(i): tuple(data) for i, data in meta['alternatives']
+        }
+        self.size = size
+        self.unpacked = {}
+        self.cache = {}
+
+    def get_pattern(self, index):
+        """Returns (offset, values) of a pattern, as in Hyph_dict.patterns."""
+        p = self.unpacked.get(index)
+        if p is None:
+            index -= 1
+            start = self.pattern_start[index]
+            value = []
+            for i in range(start, start + self.pattern_length[index]):
+                v = self.values[i]
+                if i in self.alternatives:
+                    v = dint(v, self.alternatives[i])
+                value.append(v)
+            p = self.unpacked[index + 1] = (
+                self.pattern_offset[index], value)
+        return p
+
+    def positions(self, word):
+        """
+        Returns a list of positions where the word can be hyphenated.
+        See Hyph_dict.positions.
+        """
+        word = word.lower()
+        points = self.cache.get(word)
+        if points is None:
+            base, check, pattern = self.base, self.check, self.pattern
+            size = self.size
+            codes = [self.codes.get(c, 0) for c in '.%s.' % word]
+            res = [0] * (len(codes) + 1)
+            for i in range(len(codes) - 1):
+                node = 0
+                for j in range(i, len(codes)):
+                    code = codes[j]
+                    if not code:
+                        break
+                    child = base[node] + code
+                    if child >= size or check[child] != node + 1:
+                        break
+                    node = child
+                    index = pattern[node]
+                    if index:
+                        offset, value = self.get_pattern(index)
+                        k = i + offset
+                        for v in value:
+                            if v >= res[k]:
+                                res[k] = v
+                            k += 1
+
+            points = [dint(i - 1, ref=r) for i, r in enumerate(res) if r % 2]
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
             self.cache[word] = points
         return points
 
 
+def load_dict(filename):
+    """
+    Loads a dictionary, either a hyph_*.dic file or a compiled one.
+
+    A compiled dictionary next to a .dic file is used instead of it,
+    unless the .dic file is newer. Otherwise the dictionary is compiled
+    into CACHE_DIR on first use. If no compiled dictionary can be used,
+    the .dic file is read.
+    """
+    if filename.endswith(COMPILED_SUFFIX):
+        return Compiled_hyph_dict(filename)
+    candidates = [get_compiled_name(filename)]
+    if CACHE_DIR is not None:
+        candidates.append(get_cached_name(filename))
+    for compiled in candidates:
+        try:
+            if os.path.getmtime(compiled) >= os.path.getmtime(filename):
+                return Compiled_hyph_dict(compiled)
+        except (OSError, ValueError):
+            pass
+    if CACHE_DIR is not None:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            return Compiled_hyph_dict(
+                compile_dict(filename, get_cached_name(filename)))
+        except (OSError, ValueError):
+            pass
+    return Hyph_dict(filename)
+
+
 class Hyphenator(object):
     """
     Reads a hyph_*.dic file and stores the hyphenation patterns.
@@ -157,12 +449,56 @@ class Hyphenator(object):
       h = Hyphenator(file)
       h.left = 1
     """
-    def __init__(self, filename, left=2, right=2, cache=True):
+    def __init__(self, filename, left=2, right=2, cache=True,
+                 cache_size=CACHE_SIZE):
         self.left  = left
         self.right = right
-        if not cache or filename not in hdcache:
-            hdcache[filename] = Hyph_dict(filename)
-        self.hd = hdcache[filename]
+        with hdcache_lock:
+            hd = hdcache.get(filename) if cache else None
+            if hd is None:
+                hd = load_dict(filename)
+            hdcache[filename] = hd
+            hdcache.move_to_end(filename)
+            while len(hdcache) > DICT_CACHE_SIZE:
+                hdcache.popitem(last=False)
+        self.hd = hd
+        # LRU of hyphenated words, for hyphenate_text.
+        self.cached_inserted = lru_cache(maxsize=cache_size)(
+            self._inserted)
+
+    def _inserted(self, word, hyphen, left, right):
+        # left and right are only a part of the cache key.
+        return self.inserted(word, hyphen)
+
+    def hyphenate_text(self, text, hyphen='-'):
+        """
+        Returns the text with all the possible hyphens inserted
+        in every word. Hyphenated words are kept in a bounded LRU cache.
+        """
+        inserted = self.cached_inserted
+        left, right = self.left, self.right
+        return WORD_RE.sub(
+            lambda m: inserted(m.group(), hyphen, left, right), text)
+
+    def prehyphenate(self, texts, hyphen='-'):
+        """
+        Hyphenates the vocabulary of the texts in one batch, so that
+        hyphenate_text finds the words in cache. The cache is enlarged
+        if the vocabulary doesn't fit in it.
+        Returns the number of distinct words.
+        """
+        words = set()
+        for text in texts:
+            if text:
+                words.update(WORD_RE.findall(text))
+        if len(words) > self.cached_inserted.cache_info().maxsize:
+            self.cached_inserted = lru_cache(maxsize=len(words))(
+                self._inserted)
+        inserted = self.cached_inserted
+        left, right = self.left, self.right
+        for word in words:
+            inserted(word, hyphen, left, right)
+        return len(words)
 
     def positions(self, word):
         """
@@ -228,8 +564,13 @@ class Hyphenator(object):
 
 if __name__ == "__main__":
 
+    if sys.argv[1] == 'compile':
+        for dict_file in sys.argv[2:]:
+            print(compile_dict(dict_file))
+        sys.exit()
+
     dict_file = sys.argv[1]
-    word = sys.argv[2].decode('latin1')
+    word = sys.argv[2]
 
     h = Hyphenator(dict_file, left=1, right=1)
 
@@ -0,0 +1,302 @@
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
+#
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import io
+import json
+import os
+import sqlite3
+from lxml import etree
+from librarian import ParseError, ValidationError
+from librarian.dcparser import BookInfo
+from librarian.meta.types.wluri import WLURI
+
+
+def get_slug(uri):
+    return WLURI.from_text(uri).slug
+
+
+def _read_info(file_name, old_sha1=None):
+    """
+    Returns (sha1, rdf xml, info dict, slugs, error message) for a file,
+    where slugs are the book's (slug, variant_of slug, part slugs).
+    If the content hasn't changed, it's not parsed and only sha1 is given.
+    """
+    try:
+        with open(file_name, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        return None, None, None, None, str(e)
+    sha1 = hashlib.sha1(data).hexdigest()
+    if sha1 == old_sha1:
+        return sha1, None, None, None, None
+    try:
+        info = BookInfo.from_header(io.BytesIO(data))
+        info_dict = info.to_dict()
+        slugs = (
+            get_slug(info_dict['url']),
+            get_slug(info_dict['variant_of'])
+            if 'variant_of' in info_dict else None,
+            [get_slug(uri) for uri in info_dict.get('parts', [])],
+        )
+        rdf = etree.tostring(info.to_etree(), encoding='utf-8')
+    except (ParseError, ValidationError) as e:
+        return sha1, None, None, None, str(e)
+    except Exception as e:
+        # Any other error in a single file mustn't stop the update.
+        return sha1, None, None, None, '%s: %s' % (type(e).__name__, e)
+    return sha1, rdf, info_dict, slugs, None
+
+
+class MetadataIndex:
+    """
+    Keeps the metadata of a directory of books in an SQLite database.
+
+    `update` only reads the files changed since the last update (by mtime
+    and size), and only parses those with changed content (by hash).
+    This goes for files which failed too: their errors are kept in the
+    `failure` table. A file with the slug of another indexed file fails.
+    Every book's info is stored under its slug, along with the parts graph
+    in both directions, so that metadata can be queried without touching
+    the XML files.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS book (
+            slug TEXT PRIMARY KEY,
+            file_name TEXT NOT NULL UNIQUE,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            sha1 TEXT NOT NULL,
+            rdf BLOB NOT NULL,
+            info TEXT NOT NULL,
+            variant_of TEXT
+        );
+        CREATE TABLE IF NOT EXISTS part (
+            parent TEXT NOT NULL,
+            child TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (parent, position)
+        );
+        CREATE TABLE IF NOT EXISTS failure (
+            file_name TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            sha1 TEXT,
+            message TEXT NOT NULL,
+            duplicate_of TEXT
+        );
+        CREATE INDEX IF NOT EXISTS part_child ON part (child);
+        CREATE INDEX IF NOT EXISTS book_variant_of ON book (variant_of);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(self.SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, dir_path, workers=None, suffix='.xml'):
+        """
+        Brings the index up to date with the files in `dir_path`.
+
+        Changed files are parsed in a pool of `workers` processes,
+        or in this process if `workers` isn't given.
+        Returns (updated slugs, removed slugs, errors), where errors
+        map the file names which failed in this update to messages.
+        """
+        known = {
+            file_name: (slug, mtime_ns, size, sha1)
+            for slug, file_name, mtime_ns, size, sha1
+            in self.connection.execute(
+                "SELECT slug, file_name, mtime_ns, size, sha1 FROM book")
+        }
+        failed = {
+            file_name: (mtime_ns, size, sha1, duplicate_of)
+            for file_name, mtime_ns, size, sha1, duplicate_of
+            in self.connection.execute(
+                "SELECT file_name, mtime_ns, size, sha1, duplicate_of "
+                "FROM failure")
+        }
+
+        present = sorted(
+            os.path.join(dir_path, name) for name in os.listdir(dir_path)
+            if name.endswith(suffix)
+        )
+        present_set = set(present)
+        # Files using the slug of a removed file are read again.
+        freed = {
+            slug for file_name, (slug, mtime_ns, size, sha1) in known.items()
+            if file_name not in present_set
+        }
+        stats = {}
+        for file_name in present:
+            st = os.stat(file_name)
+            stat = st.st_mtime_ns, st.st_size
+            if file_name in known and known[file_name][1:3] == stat:
+                continue
+            if file_name in failed and failed[file_name][:2] == stat and \
+                    failed[file_name][3] not in freed:
+                continue
+            stats[file_name] = stat
+
+        file_names = list(stats)
+        old_sha1s = [
+            known[file_name][3] if file_name in known
+            else failed[file_name][2]
+            if file_name in failed and failed[file_name][3] is None
+            else None
+            for file_name in file_names
+        ]
+        if workers:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(
+                    executor.map(_read_info, file_names, old_sha1s))
+        else:
+            results = list(map(_read_info, file_names, old_sha1s))
+
+        updated, removed, errors = [], [], {}
+        with self.connection:
+            for file_name, (slug, mtime_ns, size, sha1) in known.items():
+                if file_name not in present_set:
+                    self._remove(slug)
+                    removed.append(slug)
+            self.connection.executemany(
+                "DELETE FROM failure WHERE file_name = ?", (
+                    (file_name,) for file_name in failed
+                    if file_name not in present_set
+                )
+            )
+
+            for file_name, result in zip(file_names, results):
+                mtime_ns, size = stats[file_name]
+                old_slug = known[file_name][0] if file_name in known else None
+                sha1, rdf, info, slugs, error = result
+                if error is None and info is None:
+                    # Touched, but not changed.
+                    self.connection.execute(
+                        "UPDATE book SET mtime_ns = ?, size = ? "
+                        "WHERE file_name = ?", (mtime_ns, size, file_name))
+                    self.connection.execute(
+                        "UPDATE failure SET mtime_ns = ?, size = ? "
+                        "WHERE file_name = ?", (mtime_ns, size, file_name))
+                    continue
+                if old_slug is not None:
+                    self._remove(old_slug)
+
+                slug = duplicate_of = None
+                if error is None:
+                    slug, variant_of, parts = slugs
+                    row = self.connection.execute(
+                        "SELECT file_name FROM book WHERE slug = ?", (slug,)
+                    ).fetchone()
+                    if row is not None:
+                        duplicate_of = slug
+                        error = "Slug %s already used by %s." % (slug, row[0])
+
+                if old_slug is not None and (
+                        error is not None or slug != old_slug):
+                    removed.append(old_slug)
+                if error is not None:
+                    errors[file_name] = error
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO failure (file_name, "
+                        "mtime_ns, size, sha1, message, duplicate_of) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (file_name, mtime_ns, size, sha1, error, duplicate_of)
+                    )
+                    continue
+
+                self.connection.execute(
+                    "DELETE FROM failure WHERE file_name = ?", (file_name,))
+                self.connection.execute(
+                    "INSERT INTO book (slug, file_name, mtime_ns, size, "
+                    "sha1, rdf, info, variant_of) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+                        slug, file_name, mtime_ns, size, sha1, rdf,
+                        json.dumps(info), variant_of,
+                    )
+                )
+                self.connection.executemany(
+                    "INSERT INTO part (parent, child, position) "
+                    "VALUES (?, ?, ?)", (
+                        (slug, part, i) for i, part in enumerate(parts)
+                    )
+                )
+                updated.append(slug)
+        return updated, removed, errors
+
+    def _remove(self, slug):
+        self.connection.execute("DELETE FROM book WHERE slug = ?", (slug,))
+        self.connection.execute("DELETE FROM part WHERE parent = ?", (slug,))
+        # Files which failed for using this slug get another chance.
+        self.connection.execute(
+            "DELETE FROM failure WHERE duplicate_of = ?", (slug,))
+
+    def get_errors(self):
+        """Returns the messages for all the files which failed, by name."""
+        return dict(self.connection.execute(
+            "SELECT file_name, message FROM failure ORDER BY file_name"))
+
+    def __contains__(self, slug):
+        return self.connection.execute(
+            "SELECT 1 FROM book WHERE slug = ?", (slug,)
+        ).fetchone() is not None
+
+    def slugs(self):
+        return [
+            slug for slug, in self.connection.execute(
+                "SELECT slug FROM book ORDER BY slug")
+        ]
+
+    def _get(self, column, slug):
+        row = self.connection.execute(
+            "SELECT %s FROM book WHERE slug = ?" % column, (slug,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(slug)
+        return row[0]
+
+    def get(self, slug):
+        """Returns the book's metadata, as in `BookInfo.to_dict`."""
+        return json.loads(self._get('info', slug))
+
+    def get_info(self, slug, cls=BookInfo):
+        """Returns the book's metadata as an info object."""
+        return cls.from_element(etree.fromstring(self._get('rdf', slug)))
+
+    def get_file_name(self, slug):
+        return self._get('file_name', slug)
+
+    def get_parts(self, slug):
+        """Returns the slugs of the book's parts, in order."""
+        return [
+            child for child, in self.connection.execute(
+                "SELECT child FROM part WHERE parent = ? ORDER BY position",
+                (slug,))
+        ]
+
+    def get_parents(self, slug):
+        """Returns the slugs of the books which have this one as a part."""
+        return [
+            parent for parent, in self.connection.execute(
+                "SELECT parent FROM part WHERE child = ? ORDER BY parent",
+                (slug,))
+        ]
+
+    def get_variants(self, slug):
+        """Returns the slugs of the books which are variants of this one."""
+        return [
+            variant for variant, in self.connection.execute(
+                "SELECT slug FROM book WHERE variant_of = ? ORDER BY slug",
+                (slug,))
+        ]
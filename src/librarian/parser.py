@@ -2,9 +2,10 @@
 # Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
 #
 from collections import Counter
-import io
+import mmap
 import os
 import re
+import threading
 from xml.parsers.expat import ExpatError
 from lxml import etree
 from lxml.etree import XMLSyntaxError, XSLTApplyError
@@ -15,23 +16,76 @@ from librarian import dcparser
 from .elements import WL_ELEMENTS
 
 
-class WLElementLookup(etree.CustomElementClassLookup):
-    def lookup(self, node_type, document, namespace, name):
-        if node_type != 'element':
-            return
-        if namespace:
-            return
-        try:
-            return WL_ELEMENTS[name]
-        except KeyError:
-            return
+class WLElementLookup(etree.ElementNamespaceClassLookup):
+    """
+    Maps non-namespaced tags to classes from WL_ELEMENTS.
+
+    The lookup is done by lxml itself, without calling back into Python
+    for every element proxy. Anything else gets the default classes.
+    """
+    def __init__(self, elements=WL_ELEMENTS):
+        super().__init__(etree.ElementDefaultClassLookup())
+        self.get_namespace(None).update(elements)
+
+
+def make_parser():
+    """Creates an XMLParser producing WL element classes."""
+    parser = etree.XMLParser()
+    parser.set_element_class_lookup(
+        WLElementLookup()
+    )
+    return parser
+
+
+parser = make_parser()
+
+# lxml parsers can't be used by several threads at once.
+_local = threading.local()
+_local.parser = parser
+
+
+def get_parser():
+    """Returns the WL parser for the current thread."""
+    try:
+        return _local.parser
+    except AttributeError:
+        _local.parser = make_parser()
+        return _local.parser
+
 
+BOM = '\ufeff'.encode('utf-8')
 
-parser = etree.XMLParser()
-parser.set_element_class_lookup(
-    WLElementLookup()
-)
 
+def parse_xml(xmlfile, parser=None):
+    """
+    Parses a file name, a file object or bytes, ignoring any BOMs.
+
+    The data is only copied when there are BOMs to remove. Otherwise,
+    libxml2 reads the named file or the given bytes directly.
+    """
+    if isinstance(xmlfile, str):
+        with open(xmlfile, 'rb') as f:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if m.find(BOM) != -1:
+                        data = m[:]
+                    else:
+                        data = None
+            except ValueError:
+                # Empty file.
+                data = None
+        if data is None:
+            return etree.parse(xmlfile, parser)
+    elif isinstance(xmlfile, bytes):
+        data = xmlfile
+    else:
+        data = xmlfile.read()
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+    if BOM in data:
+        data = data.replace(BOM, b'')
+    return etree.fromstring(data, parser).getroottree()
 
 
 class WLDocument:
@@ -69,29 +123,16 @@ class WLDocument:
 
     @classmethod
     def from_bytes(cls, xml, *args, **kwargs):
-        return cls.from_file(io.BytesIO(xml), *args, **kwargs)
+        return cls.from_file(xml, *args, **kwargs)
 
     @classmethod
     def from_file(cls, xmlfile, *args, **kwargs):
-
-        # first, prepare for parsing
-        if isinstance(xmlfile, str):
-            file = open(xmlfile, 'rb')
-            try:
-                data = file.read()
-            finally:
-                file.close()
-        else:
-            data = xmlfile.read()
-
-        if not isinstance(data, str):
-            data = data.decode('utf-8')
-
-        data = data.replace('\ufeff', '')
-
+        """
+        Parses a document from a file name, a file object or bytes.
+        """
         try:
             parser = etree.XMLParser(remove_blank_text=False)
-            tree = etree.parse(io.BytesIO(data.encode('utf-8')), parser)
+            tree = parse_xml(xmlfile, parser)
 
             return cls(tree, *args, **kwargs)
         except (ExpatError, XMLSyntaxError, XSLTApplyError) as e:
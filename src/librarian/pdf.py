@@ -25,7 +25,7 @@ from lxml import etree
 from lxml.etree import XMLSyntaxError, XSLTApplyError
 
 from librarian.dcparser import Person
-from librarian.parser import WLDocument
+from librarian.parser import WLDocument, parse_xml
 from librarian import ParseError, DCNS, get_resource, OutputFile, RDFNS
 from librarian import functions
 from librarian.cover import make_cover
@@ -442,6 +442,49 @@ def transform(wldoc, verbose=False, save_tex=None, morefloats=None,
         raise ParseError(e)
 
 
+# Runs of characters which need other fonts: Cyrillic and geometric shapes
+# go to <alien>, Hebrew goes to <fallback>.
+SCRIPTS_RE = re.compile(
+    r"([\u0400-\u04ff]+)|([\u25a0-\u25ff]+)|([\u0590-\u05ff]+)")
+
+
+def split_scripts(root, text):
+    """
+    Splits text into the leading text and a list of wrapping elements
+    (with tails) for the runs in SCRIPTS_RE.
+    """
+    parts = SCRIPTS_RE.split(text)
+    wrappers = []
+    for i in range(1, len(parts), 4):
+        cyrillic, shapes, hebrew = parts[i:i + 3]
+        if hebrew is not None:
+            wrapper = root.makeelement('fallback')
+            wrapper.text = hebrew
+        else:
+            wrapper = root.makeelement('alien')
+            wrapper.text = cyrillic or shapes
+        wrapper.tail = parts[i + 3]
+        wrappers.append(wrapper)
+    return parts[0], wrappers
+
+
+def wrap_scripts(root):
+    """Wraps runs of characters matching SCRIPTS_RE in the tree."""
+    for element in list(root.iter()):
+        if isinstance(element.tag, str) and element.text \
+                and SCRIPTS_RE.search(element.text):
+            element.text, wrappers = split_scripts(root, element.text)
+            for i, wrapper in enumerate(wrappers):
+                element.insert(i, wrapper)
+        parent = element.getparent()
+        if parent is not None and element.tail \
+                and SCRIPTS_RE.search(element.tail):
+            element.tail, wrappers = split_scripts(root, element.tail)
+            index = parent.index(element) + 1
+            for i, wrapper in enumerate(wrappers):
+                parent.insert(index + i, wrapper)
+
+
 def load_including_children(wldoc=None, provider=None, uri=None):
     """ Makes one big xml file with children inserted at end.
 
@@ -450,25 +493,23 @@ def load_including_children(wldoc=None, provider=None, uri=None):
 
     if uri and provider:
         f = provider.by_slug(uri.slug)
-        text = f.read().decode('utf-8')
+        data = f.read()
         f.close()
+        try:
+            tree = parse_xml(data, etree.XMLParser(remove_blank_text=False))
+        except XMLSyntaxError as e:
+            raise ParseError(e)
     elif wldoc is not None:
-        text = etree.tostring(wldoc.edoc, encoding='unicode')
+        tree = deepcopy(wldoc.edoc)
         provider = wldoc.provider
     else:
         raise ValueError(
             'Neither a WLDocument, nor provider and URI were provided.'
         )
 
-    # Cyrrilic
-    text = re.sub(r"([\u0400-\u04ff]+)", r"<alien>\1</alien>", text)
-    # Geometric shapes.
-    text = re.sub(r"([\u25a0-\u25ff]+)", r"<alien>\1</alien>", text)
-    # Hebrew
-    text = re.sub(r"([\u0590-\u05ff]+)", r"<fallback>\1</fallback>", text)
+    wrap_scripts(tree.getroot())
 
-    document = WLDocument.from_bytes(text.encode('utf-8'),
-                                     parse_dublincore=True, provider=provider)
+    document = WLDocument(tree, parse_dublincore=True, provider=provider)
     document.swap_endlines()
 
     for child_uri in document.book_info.parts:
@@ -3,8 +3,8 @@
 #
 from operator import and_
 import functools
-import io
 from .dcparser import Field, WorkInfo, DCNS
+from .parser import parse_xml
 from librarian import (RDFNS, ValidationError, NoDublinCore, ParseError, WLURI)
 from xml.parsers.expat import ExpatError
 from os import path
@@ -113,33 +113,17 @@ class WLPicture:
 
     @classmethod
     def from_bytes(cls, xml, *args, **kwargs):
-        return cls.from_file(io.BytesIO(xml), *args, **kwargs)
+        return cls.from_file(xml, *args, **kwargs)
 
     @classmethod
     def from_file(cls, xmlfile, parse_dublincore=True, image_store=None):
-
-        # first, prepare for parsing
-        if isinstance(xmlfile, str):
-            file = open(xmlfile, 'rb')
-            try:
-                data = file.read()
-            finally:
-                file.close()
-        else:
-            data = xmlfile.read()
-
-        if not isinstance(data, str):
-            data = data.decode('utf-8')
-
-        data = data.replace('\ufeff', '')
-
         # assume images are in the same directory
         if image_store is None and getattr(xmlfile, 'name', None):
             image_store = ImageStore(path.dirname(xmlfile.name))
 
         try:
             parser = etree.XMLParser(remove_blank_text=False)
-            tree = etree.parse(io.BytesIO(data.encode('utf-8')), parser)
+            tree = parse_xml(xmlfile, parser)
 
             me = cls(tree, parse_dublincore=parse_dublincore,
                      image_store=image_store)
@@ -0,0 +1,327 @@
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
+#
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import tarfile
+import threading
+import zipfile
+import zlib
+from librarian import DocProvider, OutputFile
+
+
+class CachingDocProvider(DocProvider):
+    """
+    Keeps recently used documents from another provider in memory.
+
+    Cached documents are checked against the provider's `stat`
+    (e.g. mtime and size) on every use, and read again if changed.
+    Documents for which `stat` gives None can't be checked, so they're
+    not cached at all.
+    """
+
+    def __init__(self, provider, max_bytes=64 * 1024 * 1024):
+        self.provider = provider
+        self.max_bytes = max_bytes
+        # Slug -> (stat, data), least recently used first.
+        self.cache = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def by_slug(self, slug):
+        return io.BytesIO(self.get_bytes(slug))
+
+    def stat(self, slug):
+        return self.provider.stat(slug)
+
+    def get_bytes(self, slug):
+        stat = self.provider.stat(slug)
+        if stat is None:
+            with self.provider.by_slug(slug) as f:
+                return f.read()
+        with self.lock:
+            entry = self.cache.get(slug)
+            if entry is not None and entry[0] == stat:
+                self.cache.move_to_end(slug)
+                return entry[1]
+
+        with self.provider.by_slug(slug) as f:
+            data = f.read()
+
+        with self.lock:
+            old = self.cache.pop(slug, None)
+            if old is not None:
+                self.size -= len(old[1])
+            if len(data) <= self.max_bytes:
+                self.cache[slug] = stat, data
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _slug, (_stat, evicted) = self.cache.popitem(last=False)
+                    self.size -= len(evicted)
+        return data
+
+    def prefetch(self, slugs, workers=4):
+        """
+        Reads the documents into the cache, using a pool of threads.
+
+        Documents which can't be read are skipped.
+        """
+        def fetch(slug):
+            try:
+                self.get_bytes(slug)
+            except Exception:
+                pass
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(fetch, slugs))
+
+
+class ArchiveDocProvider(DocProvider):
+    """
+    Serves docs straight from a zip or uncompressed tar archive.
+
+    Members named <slug>.xml, in any directory, are indexed once when
+    opened. Their contents are then read from a memory-mapped archive,
+    without extracting anything.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.zipfile = None
+        # Slug -> (offset, stored size, size, ZipInfo or None if stored).
+        self.index = {}
+        if zipfile.is_zipfile(path):
+            self.index_zip()
+        else:
+            self.index_tar()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.zipfile is not None:
+            self.zipfile.close()
+        self.mmap.close()
+        self.file.close()
+
+    @staticmethod
+    def get_slug(name):
+        name = os.path.basename(name)
+        if name.endswith('.xml'):
+            return name[:-4]
+
+    def index_zip(self):
+        self.zipfile = zipfile.ZipFile(self.file)
+        for info in self.zipfile.infolist():
+            slug = self.get_slug(info.filename)
+            if slug is None or info.is_dir() or slug in self.index:
+                continue
+            # The local header may have different extra fields
+            # than the central directory.
+            header = self.mmap[info.header_offset:info.header_offset + 30]
+            if header[:4] != b'PK\x03\x04':
+                raise zipfile.BadZipFile(
+                    "Bad local header for %s" % info.filename)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            offset = info.header_offset + 30 + name_length + extra_length
+            self.index[slug] = (
+                offset, info.compress_size, info.file_size, info
+            )
+
+    def index_tar(self):
+        with tarfile.open(fileobj=self.file, mode='r:') as tar:
+            for info in tar:
+                slug = self.get_slug(info.name)
+                if slug is None or not info.isfile() or slug in self.index:
+                    continue
+                self.index[slug] = (
+                    info.offset_data, info.size, info.size, None
+                )
+
+    def get_entry(self, slug):
+        try:
+            return self.index[slug]
+        except KeyError:
+            raise FileNotFoundError(
+                "No %s.xml in %s" % (slug, self.path))
+
+    def get_bytes(self, slug):
+        offset, stored_size, size, info = self.get_entry(slug)
+        if info is not None and info.compress_type not in (
+                zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            # Other compression methods are left to zipfile.
+            return self.zipfile.read(info)
+        data = self.mmap[offset:offset + stored_size]
+        if info is not None and info.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -zlib.MAX_WBITS, size)
+        return data
+
+    def by_slug(self, slug):
+        return io.BytesIO(self.get_bytes(slug))
+
+    def stat(self, slug):
+        # The archive doesn't change while open.
+        return self.get_entry(slug)[:3]
+
+
+class SQLiteDocProvider(DocProvider):
+    """
+    Serves docs from an SQLite database, and stores built outputs in it.
+
+    Documents are kept in the `document` table, each with a version
+    number, which grows with every `add_documents`. Outputs are kept in
+    the `output` table, keyed by slug, builder name and a hash of the build
+    options, along with the version of the document they were built from.
+    Every thread uses its own connection.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS document (
+            slug TEXT PRIMARY KEY,
+            xml BLOB NOT NULL,
+            version INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS revision (
+            version INTEGER PRIMARY KEY AUTOINCREMENT
+        );
+        CREATE TABLE IF NOT EXISTS output (
+            slug TEXT NOT NULL,
+            builder TEXT NOT NULL,
+            options_hash TEXT NOT NULL,
+            source_version INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (slug, builder, options_hash)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connection.executescript(self.SCHEMA)
+
+    @property
+    def connection(self):
+        try:
+            return self.local.connection
+        except AttributeError:
+            self.local.connection = sqlite3.connect(self.path)
+            return self.local.connection
+
+    def close(self):
+        """Closes the connection of the current thread."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            del self.local.connection
+
+    @staticmethod
+    def get_options_hash(options=None):
+        return hashlib.sha1(
+            json.dumps(options or {}, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()
+
+    def get_document(self, slug):
+        """Returns the document's (version, bytes)."""
+        row = self.connection.execute(
+            "SELECT version, xml FROM document WHERE slug = ?", (slug,)
+        ).fetchone()
+        if row is None:
+            raise FileNotFoundError("No document %s in %s" % (slug, self.path))
+        return row
+
+    def get_version(self, slug):
+        row = self.connection.execute(
+            "SELECT version FROM document WHERE slug = ?", (slug,)
+        ).fetchone()
+        if row is None:
+            raise FileNotFoundError("No document %s in %s" % (slug, self.path))
+        return row[0]
+
+    def by_slug(self, slug):
+        return io.BytesIO(self.get_document(slug)[1])
+
+    def stat(self, slug):
+        return self.get_version(slug)
+
+    def add_documents(self, documents):
+        """
+        Adds or replaces documents, given as (slug, bytes) pairs.
+
+        Returns their new version.
+        """
+        with self.connection:
+            # Autoincrement never reuses a number, even after deleting.
+            version = self.connection.execute(
+                "INSERT INTO revision DEFAULT VALUES").lastrowid
+            self.connection.execute(
+                "DELETE FROM revision WHERE version < ?", (version,))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO document (slug, xml, version) "
+                "VALUES (?, ?, ?)",
+                ((slug, xml, version) for slug, xml in documents)
+            )
+        return version
+
+    def save_outputs(self, outputs):
+        """
+        Stores OutputFiles in a single transaction.
+
+        Outputs are given as (slug, builder name, options, source version,
+        OutputFile), where the source version is the one of the document
+        the output was built from, as given by `get_document` or
+        `get_version` before building.
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO output "
+                "(slug, builder, options_hash, source_version, data) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        slug, builder, self.get_options_hash(options),
+                        source_version, output.get_bytes()
+                    )
+                    for slug, builder, options, source_version, output
+                    in outputs
+                )
+            )
+
+    def save_output(self, slug, builder, source_version, output,
+                    options=None):
+        self.save_outputs([(slug, builder, options, source_version, output)])
+
+    def get_output(self, slug, builder, options=None):
+        """Returns a stored OutputFile, if up to date with the document."""
+        row = self.connection.execute(
+            "SELECT output.data FROM output JOIN document USING (slug) "
+            "WHERE slug = ? AND builder = ? AND options_hash = ? "
+            "AND source_version = version",
+            (slug, builder, self.get_options_hash(options))
+        ).fetchone()
+        if row is not None:
+            return OutputFile.from_bytes(row[0])
+
+    def get_stale(self, builder, options=None):
+        """Lists slugs of documents without an up to date output."""
+        return [
+            slug for slug, in self.connection.execute(
+                "SELECT document.slug FROM document LEFT JOIN output "
+                "ON output.slug = document.slug AND builder = ? "
+                "AND options_hash = ? "
+                "WHERE output.slug IS NULL OR source_version != version "
+                "ORDER BY document.slug",
+                (builder, self.get_options_hash(options))
+            )
+        ]
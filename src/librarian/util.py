@@ -2,7 +2,9 @@
 # by Paul Winkler
 # http://code.activestate.com/recipes/81611-roman-numerals/
 # PSFL (GPL compatible)
+from functools import lru_cache
 import os
+import re
 
 
 def int_to_roman(input):
@@ -127,6 +129,7 @@ def makedirs(path):
         os.makedirs(path)
 
 
+@lru_cache(maxsize=32)
 def get_translation(language):
     import gettext
     from .functions import lang_code_3to2
@@ -136,3 +139,61 @@ def get_translation(language):
         localedir=os.path.join(os.path.dirname(__file__), 'locale'),
         languages=[lang_code_3to2(language), 'pl'],
     )
+
+
+ORPHANS_RE = re.compile(r'(?<=\s\w)\s+')
+
+
+class TextNormalizer:
+    """
+    Normalizes text for a builder: applies the substitutions in one pass,
+    then the hyphenator, then binds one-letter words to the next ones
+    if `orphans` is set. Results for recent texts are memoized.
+
+    At any position, earlier substitutions take precedence.
+    """
+
+    def __init__(self, substitutions, hyphenator=None, orphans=False,
+                 cache_size=4096):
+        self.replacements = {}
+        for old, new in substitutions:
+            self.replacements.setdefault(old, new)
+        self.substitute = None
+        if self.replacements:
+            self.substitute = re.compile('|'.join(
+                re.escape(old) for old in self.replacements
+            )).sub
+        self.hyphenator = hyphenator
+        self.orphans = orphans
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def _normalize(self, text):
+        if self.substitute is not None:
+            replacements = self.replacements
+            text = self.substitute(lambda m: replacements[m.group()], text)
+        if self.hyphenator is not None:
+            text = self.hyphenator.hyphenate_text(text, '\u00AD')
+        if self.orphans:
+            text = ORPHANS_RE.sub('\u00A0', text)
+        return text
+
+    def __call__(self, text):
+        return self.normalize(text)
+
+
+def get_normalizer(builder, substitutions):
+    """
+    Returns the builder's normalizer for a substitution table,
+    compiling it on first use or when the builder's settings change.
+    Normalizers are kept in the builder's `normalizers`, by table.
+    """
+    normalizers = getattr(builder, 'normalizers', None)
+    if normalizers is None:
+        normalizers = builder.normalizers = {}
+    hyphenator = getattr(builder, 'hyphenator', None)
+    normalizer = normalizers.get(id(substitutions))
+    if normalizer is None or normalizer.hyphenator is not hyphenator \
+            or normalizer.orphans != builder.orphans:
+        normalizer = normalizers[id(substitutions)] = TextNormalizer(
+            substitutions, hyphenator, builder.orphans)
+    return normalizer
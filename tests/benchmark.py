@@ -0,0 +1,88 @@
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
+#
+"""
+Parse-and-build benchmark over the text fixtures.
+
+Run with: python -m tests.benchmark [-n ROUNDS] [BUILDER...]
+
+Compares the element class lookup used by the parser with a plain
+Python CustomElementClassLookup, as used before.
+"""
+import argparse
+import time
+from lxml import etree
+from librarian.builders import builders
+from librarian.document import WLDocument
+from librarian.elements import WL_ELEMENTS
+from librarian.parser import parser, WLElementLookup
+from .utils import get_all_fixtures
+
+
+class PythonElementLookup(etree.CustomElementClassLookup):
+    def lookup(self, node_type, document, namespace, name):
+        if node_type != 'element':
+            return
+        if namespace:
+            return
+        try:
+            return WL_ELEMENTS[name]
+        except KeyError:
+            return
+
+
+def run(filenames, builder_names):
+    for filename in filenames:
+        doc = WLDocument(filename=filename)
+        for name in builder_names:
+            doc.build(builders[name])
+
+
+def check(filenames, builder_names):
+    """Leaves out the fixtures which can't be built."""
+    good = []
+    for filename in filenames:
+        try:
+            run([filename], builder_names)
+        except Exception as e:
+            print('Skipping {}: {}'.format(filename, e))
+        else:
+            good.append(filename)
+    return good
+
+
+def measure(filenames, builder_names, rounds):
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        run(filenames, builder_names)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    argparser.add_argument('-n', '--rounds', type=int, default=20)
+    argparser.add_argument('builders', nargs='*', default=['txt', 'html'])
+    args = argparser.parse_args()
+
+    filenames = check(get_all_fixtures('text', '*.xml'), args.builders)
+    results = {}
+    for label, lookup in [
+            ('python lookup', PythonElementLookup()),
+            ('namespace lookup', WLElementLookup()),
+    ]:
+        parser.set_element_class_lookup(lookup)
+        results[label] = measure(filenames, args.builders, args.rounds)
+        print('{:<20} {:8.3f} s'.format(label, results[label]))
+    parser.set_element_class_lookup(WLElementLookup())
+
+    base = results['python lookup']
+    print('{:<20} {:8.1%}'.format(
+        'change', (results['namespace lookup'] - base) / base))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,16 @@
 # This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
 # Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
 #
+import io
+import os
+import shutil
+import tempfile
 import unittest
+from librarian import NoDublinCore, ParseError
 from librarian import dcparser
 from lxml import etree
 from os.path import splitext
-from tests.utils import get_all_fixtures
+from tests.utils import get_all_fixtures, get_fixture, get_fixture_dir
 
 
 class MetaTests(unittest.TestCase):
@@ -37,12 +42,54 @@ class MetaTests(unittest.TestCase):
         info_bis = dcparser.BookInfo.from_bytes(serialized)
 
         # check if they are the same
-        for key in vars(info):
-            self.assertEqual(getattr(info, key), getattr(info_bis, key))
-        for key in vars(info_bis):
+        for key in ['about', *info.fmap]:
             self.assertEqual(getattr(info, key), getattr(info_bis, key))
 
     def test_serialize(self):
         for fixture in get_all_fixtures('dcparser', '*.xml'):
             with self.subTest(name=fixture):
                 self.check_serialize(fixture)
+
+    def test_from_header(self):
+        for fixture in get_all_fixtures('dcparser', '*.xml'):
+            with self.subTest(name=fixture):
+                self.assertEqual(
+                    dcparser.BookInfo.from_header(fixture).to_dict(),
+                    dcparser.parse(fixture).to_dict()
+                )
+
+    def test_from_header_stops_at_rdf(self):
+        with open(get_fixture('dcparser', 'mickiewicz_rybka.xml'), 'rb') as f:
+            xml = f.read()
+        end = xml.index(b'</rdf:RDF>') + len(b'</rdf:RDF>')
+        # Garbage after the header is never read.
+        info = dcparser.BookInfo.from_header(
+            io.BytesIO(xml[:end] + b'<<<'), chunk_size=64)
+        self.assertEqual(info.to_dict(), dcparser.parse(
+            io.BytesIO(xml)).to_dict())
+
+        with self.assertRaises(ParseError):
+            dcparser.BookInfo.from_header(io.BytesIO(xml[:end - 20]))
+        with self.assertRaises(NoDublinCore):
+            dcparser.BookInfo.from_header(io.BytesIO(b'<utwor></utwor>'))
+
+    def test_scan_dir(self):
+        infos = dcparser.scan_dir(get_fixture_dir('text'), workers=2)
+        self.assertIsInstance(
+            infos[get_fixture('text', 'asnyk_zbior.xml')], dcparser.BookInfo)
+        self.assertIsInstance(
+            infos[get_fixture('text', 'abstrakt.xml')], NoDublinCore)
+
+    def test_scan_dir_errors(self):
+        with tempfile.TemporaryDirectory() as path:
+            shutil.copy(get_fixture('text', 'do-mlodych.xml'), path)
+            # Can't be opened as a file.
+            os.mkdir(os.path.join(path, 'dir.xml'))
+            with open(os.path.join(path, 'bad.xml'), 'wb') as f:
+                f.write(b'\xff\xfe<<')
+            infos = dcparser.scan_dir(path, workers=2)
+        self.assertIsInstance(
+            infos[os.path.join(path, 'do-mlodych.xml')], dcparser.BookInfo)
+        self.assertIsInstance(infos[os.path.join(path, 'dir.xml')], OSError)
+        self.assertIsInstance(
+            infos[os.path.join(path, 'bad.xml')], Exception)
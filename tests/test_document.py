@@ -0,0 +1,317 @@
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
+#
+from unittest import TestCase
+from lxml import etree
+from librarian import DirDocProvider, DocumentFrozen, RDFNS
+from librarian.builders import builders
+from librarian.dcparser import BookInfo
+from librarian.document import WLDocument
+from librarian.elements.base import CONTEXT_SETTINGS, WLElement
+from librarian.elements.masters import Master
+from librarian.elements.root import Utwor
+from .utils import get_fixture, get_fixture_dir
+
+
+class DocumentTests(TestCase):
+    def test_assign_ids(self):
+        doc = WLDocument(filename=get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'))
+        doc.assign_ids()
+
+        ids = [
+            e.attrib['id'] for e in doc.tree.getroot().iter()
+            if getattr(e, 'SHOULD_HAVE_ID', False)
+        ]
+        self.assertTrue(ids)
+        self.assertEqual(len(ids), len(set(ids)))
+
+        new_id = doc.new_id()
+        self.assertNotIn(new_id, ids)
+        self.assertNotEqual(new_id, doc.new_id())
+
+    def test_new_id(self):
+        doc = WLDocument(filename=get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'))
+        # Ids already in the document are known without assign_ids.
+        ids = {e.get('id') for e in doc.tree.getroot().iter() if e.get('id')}
+        self.assertIn('e1', ids)
+        self.assertNotIn(doc.new_id(), ids)
+
+    def test_prepare(self):
+        doc = WLDocument(filename=get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'))
+        source = etree.tostring(doc.tree)
+
+        prepared = doc.prepare()
+        self.assertIs(doc.prepare(), prepared)
+        self.assertTrue(prepared.ordered_ids)
+        self.assertTrue(prepared.section_ids)
+        self.assertTrue(prepared.verses)
+
+        html = doc.build(builders['html']).get_bytes()
+        doc.build(builders['txt'])
+        self.assertEqual(doc.build(builders['html']).get_bytes(), html)
+        # Preprocessing doesn't touch the source tree.
+        self.assertEqual(etree.tostring(doc.tree), source)
+
+        # Modifying the tree drops the preprocessed data.
+        doc.new_id(doc.tree.getroot())
+        self.assertIsNone(doc.prepared)
+        doc.prepare()
+        builders['sanitizer']().build(doc)
+        self.assertIsNone(doc.prepared)
+
+    def test_contexts(self):
+        filename = get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml')
+
+        # Walk the ancestors of a separately parsed document, as elements
+        # did before contexts were cached. Nothing here prepares it.
+        def walk_meta(e):
+            while e is not None:
+                rdf = e.find(RDFNS('RDF'))
+                if rdf is None and isinstance(e, Utwor):
+                    # Deprecated: RDF record in master.
+                    for c in e:
+                        if isinstance(c, Master):
+                            rdf = c.find(RDFNS('RDF'))
+                            if rdf is not None:
+                                break
+                if rdf is not None:
+                    return BookInfo.from_element(rdf)
+                e = e.getparent()
+            return plain.base_meta
+
+        def walk_setting(e, setting):
+            e = e.getparent()
+            while e is not None:
+                if hasattr(e, setting):
+                    return getattr(e, setting)
+                e = e.getparent()
+            return False
+
+        def describe(meta, settings):
+            return (meta.title, str(meta.url), meta.language, settings)
+
+        plain = WLDocument(filename=filename)
+        expected = [
+            describe(walk_meta(e), [
+                walk_setting(e, setting) for setting in CONTEXT_SETTINGS
+            ])
+            for e in plain.tree.getroot().iter()
+            if isinstance(e, WLElement)
+        ]
+        self.assertIsNone(plain.prepared)
+        # The fixture has a footnote, so settings are actually inherited.
+        self.assertIn(True, [v for *_, values in expected for v in values])
+
+        doc = WLDocument(filename=filename)
+        root = doc.tree.getroot()
+        elements = [e for e in root.iter() if isinstance(e, WLElement)]
+        doc.prepare()
+        self.assertEqual(
+            [
+                describe(e.meta, [
+                    e.in_context_of(setting) for setting in CONTEXT_SETTINGS
+                ])
+                for e in elements
+            ],
+            expected
+        )
+        # Elements in the same scope share a single context.
+        master = root.master
+        child = next(c for c in master if isinstance(c, WLElement))
+        self.assertIs(master.get_context(), child.get_context())
+
+        html = doc.build(builders['html']).get_bytes()
+        doc.build(builders['epub'])
+        self.assertEqual(doc.build(builders['html']).get_bytes(), html)
+
+    def test_dispatch_pruning(self):
+        from librarian.builders.html import HtmlBuilder, SnippetHtmlBuilder
+        from librarian.builders.txt import TxtBuilder
+        from librarian.elements.base import get_dispatch_table
+        from librarian.elements.comments import Abstrakt, NotaRed
+        from librarian.elements.paragraphs import Akap
+        from librarian.elements.themes import Motyw
+
+        html = get_dispatch_table(HtmlBuilder(), 'html_build')
+        snippet = get_dispatch_table(SnippetHtmlBuilder(), 'html_build')
+        txt = get_dispatch_table(TxtBuilder(), 'txt_build')
+
+        self.assertIsNone(html[Abstrakt])
+        self.assertIsNone(txt[NotaRed])
+        self.assertIsNotNone(html[NotaRed])
+        self.assertIsNotNone(html[Motyw])
+        self.assertIsNone(snippet[Motyw])
+        self.assertIs(txt[Akap], Akap.txt_build)
+        self.assertIsNone(txt[etree._Element])
+
+        # Pruning follows the builder instance, not only its class.
+        builder = SnippetHtmlBuilder()
+        builder.with_themes = True
+        self.assertIsNotNone(get_dispatch_table(builder, 'html_build')[Motyw])
+        self.assertIsNone(snippet[Motyw])
+
+    def test_build_many(self):
+        doc = WLDocument(filename=get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'))
+        names = ['txt', 'html', 'html-snippet']
+        expected = {
+            name: WLDocument(
+                filename=get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml')
+            ).build(builders[name]).get_bytes()
+            for name in names
+        }
+        source = etree.tostring(doc.tree)
+
+        for workers in (None, 3):
+            outputs = doc.build_many(
+                {name: builders[name] for name in names + ['epub']},
+                workers=workers
+            )
+            self.assertTrue(outputs.pop('epub').get_bytes())
+            self.assertEqual(
+                {name: output.get_bytes() for name, output in outputs.items()},
+                expected
+            )
+        # EPUB only modified its own copy.
+        self.assertEqual(etree.tostring(doc.tree), source)
+
+    def test_freeze(self):
+        doc = WLDocument(
+            filename=get_fixture('text', 'asnyk_zbior.xml'),
+            provider=DirDocProvider(get_fixture_dir('text'))
+        )
+        doc.freeze()
+        source = etree.tostring(doc.tree)
+
+        with self.assertRaises(DocumentFrozen):
+            doc.assign_ids()
+        with self.assertRaises(DocumentFrozen):
+            doc.prepare(force=True)
+        # Builders which modify the document refuse to work on it directly.
+        with self.assertRaises(DocumentFrozen):
+            builders['sanitizer']().build(doc)
+
+        # Parts are loaded, prepared and frozen along with the document.
+        parts = list(doc.children)
+        self.assertEqual(len(parts), 2)
+        for part in parts:
+            self.assertTrue(part.frozen)
+            self.assertIsNotNone(part.prepared)
+
+        txt = doc.build(builders['txt']).get_bytes()
+        doc.build(builders['epub'])
+        outputs = doc.build_many(
+            {'txt': builders['txt'], 'epub': builders['epub']}, workers=2
+        )
+        self.assertEqual(outputs['txt'].get_bytes(), txt)
+        self.assertEqual(etree.tostring(doc.tree), source)
+
+    def test_parser_per_thread(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from librarian.parser import get_parser
+
+        filename = get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml')
+        expected = WLDocument(filename=filename).build(builders['txt']).get_bytes()
+
+        def work(i):
+            doc = WLDocument(filename=filename)
+            return get_parser(), doc.build(builders['txt']).get_bytes()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(work, range(8)))
+        self.assertEqual({output for p, output in results}, {expected})
+        self.assertNotIn(get_parser(), {p for p, output in results})
+        self.assertIs(get_parser(), get_parser())
+
+    def test_prepared_cache(self):
+        import os
+        import shutil
+        import tempfile
+        from librarian.document import DocumentCache
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        cache = DocumentCache(path)
+        provider = DirDocProvider(get_fixture_dir('text'))
+        for name, names in [
+                ('miedzy-nami-nic-nie-bylo.xml', ['txt', 'html', 'html-snippet']),
+                ('asnyk_zbior.xml', ['txt']),
+        ]:
+            filename = get_fixture('text', name)
+            with open(filename, 'rb') as f:
+                data = f.read()
+            cache.load(data, provider=provider)
+            cached = cache.load(data, provider=provider)
+            self.assertIsNotNone(cached.prepared)
+            for builder in names:
+                with self.subTest(name=name, builder=builder):
+                    fresh = WLDocument(filename=filename, provider=provider)
+                    self.assertEqual(
+                        cached.build(builders[builder]).get_bytes(),
+                        fresh.build(builders[builder]).get_bytes()
+                    )
+        self.assertEqual(len(os.listdir(path)), 2)
+
+    def test_prepared_cache_corrupt(self):
+        import os
+        import shutil
+        import tempfile
+        from librarian.document import DocumentCache
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        cache = DocumentCache(path)
+        with open(get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'), 'rb') as f:
+            data = f.read()
+        entry = cache.get_path(cache.get_key(data))
+        cache.load(data)
+        with open(entry, 'rb') as f:
+            dump = f.read()
+        for corrupt in b'', b'garbage', dump[:len(dump) // 2]:
+            with self.subTest(size=len(corrupt)):
+                with open(entry, 'wb') as f:
+                    f.write(corrupt)
+                self.assertIsNotNone(cache.load(data).prepared)
+                with open(entry, 'rb') as f:
+                    self.assertEqual(f.read(), dump)
+        self.assertEqual(os.listdir(path), [os.path.basename(entry)])
+
+    def test_parse_xml(self):
+        import io
+        import tempfile
+        from librarian.parser import parse_xml
+
+        xml = b'<a>x<b>\xef\xbb\xbfy</b></a>'
+        expected = b'<a>x<b>y</b></a>'
+        for data in xml, b'\xef\xbb\xbf' + xml, expected:
+            with tempfile.NamedTemporaryFile() as f:
+                f.write(data)
+                f.flush()
+                for source in data, io.BytesIO(data), f.name:
+                    with self.subTest(data=data, source=type(source)):
+                        self.assertEqual(
+                            etree.tostring(parse_xml(source)), expected)
+
+    def test_parts(self):
+        class CountingProvider(DirDocProvider):
+            def __init__(self, dir_):
+                super().__init__(dir_)
+                self.loaded = []
+
+            def by_slug(self, slug):
+                self.loaded.append(slug)
+                return super().by_slug(slug)
+
+        provider = CountingProvider(get_fixture_dir('text'))
+        doc = WLDocument(
+            filename=get_fixture('text', 'asnyk_zbior.xml'),
+            provider=provider
+        )
+        doc.preload_parts(parallel=2)
+        slugs = list(provider.loaded)
+        self.assertTrue(slugs)
+
+        stats = doc.get_statistics()
+        editors = doc.editors()
+        self.assertEqual(len(stats['parts']), len(list(doc.children)))
+        self.assertTrue(editors)
+        self.assertEqual(provider.loaded, slugs)
@@ -88,3 +88,40 @@ class EpubTests(unittest.TestCase):
             book.get_metadata(DC, "date"),
             [("2007-09-06", {})]
         )
+
+    def test_woff_fonts(self):
+        epub_file = EpubBuilder().build(
+            WLDocument(get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml')),
+            font_format='woff'
+        )
+        book = epub.read_epub(epub_file.get_filename())
+        fonts = {
+            item.file_name: item.media_type
+            for item in book.get_items()
+            if item.media_type.startswith('font/')
+        }
+        self.assertEqual(fonts, {
+            'DejaVuSerif.woff': 'font/woff',
+            'DejaVuSerif-Bold.woff': 'font/woff',
+            'DejaVuSerif-Italic.woff': 'font/woff',
+            'DejaVuSerif-BoldItalic.woff': 'font/woff',
+        })
+        style = book.get_item_with_href('style.css').get_content()
+        self.assertIn(b'url(DejaVuSerif-Bold.woff)', style)
+        self.assertNotIn(b'.ttf', style)
+
+    def test_streaming(self):
+        builder = EpubBuilder()
+        epub_file = builder.build(
+            WLDocument(get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'))
+        )
+        names = ZipFile(epub_file.get_file()).namelist()
+        self.assertEqual(names[:2], ['mimetype', 'META-INF/container.xml'])
+        # Chunks are written as they're closed, before the package document.
+        self.assertLess(
+            names.index('EPUB/part1.xhtml'),
+            names.index('EPUB/content.opf')
+        )
+        # Only the manifest is kept.
+        for item in builder.output.get_items():
+            self.assertFalse(item.content)
@@ -0,0 +1,77 @@
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
+#
+import io
+import unittest
+from fontTools.ttLib import TTFont, woff2
+from librarian import fonts, get_resource
+
+
+class StripFontsTests(unittest.TestCase):
+    def setUp(self):
+        self.paths = [
+            get_resource('fonts/DejaVuSerif.ttf'),
+            get_resource('fonts/DejaVuSerif-Bold.ttf'),
+        ]
+
+    def test_strip_fonts(self):
+        contents = fonts.strip_fonts(self.paths, 'Zażółć')
+        for path, content in zip(self.paths, contents):
+            self.assertLess(len(content), len(fonts.get_font_data(path)))
+            cmap = TTFont(io.BytesIO(content)).getBestCmap()
+            self.assertIn(ord('ż'), cmap)
+            self.assertNotIn(ord('x'), cmap)
+
+        # Cached by the set of characters.
+        again = fonts.strip_fonts(self.paths, set('ćółżaZ'))
+        for content, cached in zip(contents, again):
+            self.assertIs(content, cached)
+
+    def test_workers(self):
+        fonts.subsets.clear()
+        self.assertEqual(
+            fonts.strip_fonts(self.paths, 'abc', workers=2),
+            [fonts.subset_font(path, 'abc') for path in self.paths]
+        )
+
+    def test_shared_pool(self):
+        fonts.subsets.clear()
+        contents = fonts.strip_fonts(self.paths, 'abc')
+        executor = fonts.executors[None]
+        fonts.subsets.clear()
+        self.assertEqual(fonts.strip_fonts(self.paths, 'abc'), contents)
+        self.assertIs(fonts.executors[None], executor)
+
+    def test_woff(self):
+        content = fonts.strip_font(self.paths[0], 'abc', font_format='woff')
+        self.assertEqual(content[:4], b'wOFF')
+        self.assertLess(
+            len(content), len(fonts.strip_font(self.paths[0], 'abc')))
+
+    @unittest.skipUnless(woff2.haveBrotli, 'WOFF2 requires brotli')
+    def test_woff2(self):
+        content = fonts.strip_font(self.paths[0], 'abc', font_format='woff2')
+        self.assertEqual(content[:4], b'wOF2')
+        cmap = TTFont(io.BytesIO(content)).getBestCmap()
+        self.assertIn(ord('a'), cmap)
+        self.assertNotIn(ord('x'), cmap)
+
+    @unittest.skipUnless(woff2.haveBrotli, 'WOFF2 requires brotli')
+    def test_woff2_size_report(self):
+        report = fonts.get_size_report(self.paths, 'Zażółć')
+        for fname, sizes in report:
+            self.assertEqual(list(sizes), ['ttf', 'woff', 'woff2'])
+            self.assertLess(sizes['woff2'], sizes['woff'])
+            self.assertLess(sizes['woff'], sizes['ttf'])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            fonts.strip_font(self.paths[0], 'abc', font_format='otf')
+
+    def test_size_report(self):
+        report = fonts.get_size_report(self.paths, 'abc', ['ttf', 'woff'])
+        self.assertEqual(
+            [fname for fname, sizes in report],
+            ['DejaVuSerif.ttf', 'DejaVuSerif-Bold.ttf'])
+        for fname, sizes in report:
+            self.assertLess(sizes['woff'], sizes['ttf'])
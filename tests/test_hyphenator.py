@@ -0,0 +1,128 @@
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
+#
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from librarian import get_resource
+from librarian import hyphenator
+from tests.utils import get_all_fixtures
+
+
+class CompiledDictTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.dict_file = os.path.join(self.dir, 'hyph_pl.dic')
+        shutil.copy(
+            get_resource('res/hyph-dictionaries/hyph_pl.dic'), self.dict_file)
+        self.addCleanup(setattr, hyphenator, 'CACHE_DIR', hyphenator.CACHE_DIR)
+        hyphenator.CACHE_DIR = os.path.join(self.dir, 'cache')
+
+    def test_same_positions(self):
+        words = set()
+        for fixture in get_all_fixtures('text', '*.xml'):
+            with open(fixture, encoding='utf-8') as f:
+                words.update(re.findall(r'\w+', f.read()))
+
+        compiled = hyphenator.Compiled_hyph_dict(
+            hyphenator.compile_dict(self.dict_file))
+        text = hyphenator.Hyph_dict(self.dict_file)
+        for word in sorted(words):
+            self.assertEqual(compiled.positions(word), text.positions(word))
+
+    def test_load_dict(self):
+        # Compiled into the cache on first use.
+        self.assertIsInstance(
+            hyphenator.load_dict(self.dict_file),
+            hyphenator.Compiled_hyph_dict)
+        cached = hyphenator.get_cached_name(self.dict_file)
+        self.assertTrue(os.path.exists(cached))
+
+        compiled = hyphenator.compile_dict(self.dict_file)
+        self.assertEqual(compiled, os.path.join(self.dir, 'hyph_pl.hyb'))
+        self.assertIsInstance(
+            hyphenator.load_dict(self.dict_file),
+            hyphenator.Compiled_hyph_dict)
+
+        # Without a cache, stale compiled dictionaries aren't used.
+        hyphenator.CACHE_DIR = None
+        os.utime(compiled, (0, 0))
+        self.assertIsInstance(
+            hyphenator.load_dict(self.dict_file), hyphenator.Hyph_dict)
+
+        h = hyphenator.Hyphenator(compiled)
+        self.assertEqual(h.inserted('zaczarowana'), 'za-cza-ro-wa-na')
+
+
+    def test_truncated(self):
+        hyphenator.CACHE_DIR = None
+        compiled = hyphenator.compile_dict(self.dict_file)
+        with open(compiled, 'rb') as f:
+            data = f.read()
+        for length in (10, len(data) // 2):
+            with open(compiled, 'wb') as f:
+                f.write(data[:length])
+            with self.assertRaises(ValueError):
+                hyphenator.Compiled_hyph_dict(compiled)
+            # The source dictionary is used instead.
+            self.assertIsInstance(
+                hyphenator.load_dict(self.dict_file), hyphenator.Hyph_dict)
+
+
+class DictCacheTests(unittest.TestCase):
+    def test_bounded(self):
+        size = hyphenator.DICT_CACHE_SIZE
+        hyphenator.DICT_CACHE_SIZE = 2
+        self.addCleanup(setattr, hyphenator, 'DICT_CACHE_SIZE', size)
+
+        names = ['hyph_pl.dic', 'hyph_de.dic', 'hyph_pl.dic', 'hyph_fr.dic']
+        hyphs = [
+            hyphenator.Hyphenator(get_resource('res/hyph-dictionaries/' + name))
+            for name in names
+        ]
+        self.assertIs(hyphs[0].hd, hyphs[2].hd)
+        # The least recently used dictionary is dropped.
+        self.assertEqual(
+            [os.path.basename(name) for name in hyphenator.hdcache],
+            ['hyph_pl.dic', 'hyph_fr.dic'])
+
+
+class HyphenateTextTests(unittest.TestCase):
+    def setUp(self):
+        self.hyphenator = hyphenator.Hyphenator(
+            get_resource('res/hyph-dictionaries/hyph_pl.dic'))
+
+    def test_hyphenate_text(self):
+        text = 'Zaczarowana dorożka, zaczarowany koń...\n— (bo) "a"'
+        expected = ''.join(
+            self.hyphenator.inserted(token, '|')
+            for token in re.findall(r'\w+|\W', text)
+        )
+        self.assertEqual(self.hyphenator.hyphenate_text(text, '|'), expected)
+        self.assertEqual(
+            self.hyphenator.hyphenate_text('zaczarowana', '|'),
+            'za|cza|ro|wa|na')
+
+    def test_prehyphenate(self):
+        h = hyphenator.Hyphenator(
+            get_resource('res/hyph-dictionaries/hyph_pl.dic'), cache_size=10)
+        self.assertEqual(
+            h.prehyphenate(['ala ma kota', None, 'kota ma ala'], '|'), 3)
+        h.hyphenate_text('kota', '|')
+        info = h.cached_inserted.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 3, 3))
+
+        # Changing the settings doesn't give stale results.
+        h.left = h.right = 1
+        self.assertEqual(h.hyphenate_text('kota', '|'), 'ko|ta')
+
+    def test_prehyphenate_enlarges_cache(self):
+        h = hyphenator.Hyphenator(
+            get_resource('res/hyph-dictionaries/hyph_pl.dic'), cache_size=2)
+        self.assertEqual(h.prehyphenate(['ala ma kota'], '|'), 3)
+        h.hyphenate_text('ala ma kota', '|')
+        info = h.cached_inserted.cache_info()
+        self.assertEqual((info.hits, info.misses, info.maxsize), (3, 3, 3))
@@ -0,0 +1,113 @@
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
+#
+import os
+import shutil
+import tempfile
+import unittest
+from librarian import dcparser
+from librarian.index import MetadataIndex
+from tests.utils import get_fixture, get_fixture_dir
+
+
+class MetadataIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.books = os.path.join(self.dir, 'books')
+        shutil.copytree(get_fixture_dir('text'), self.books)
+        self.index = MetadataIndex(os.path.join(self.dir, 'index.db'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+    def test_update(self):
+        updated, removed, errors = self.index.update(self.books)
+        self.assertEqual(
+            sorted(updated), ['do-mlodych', 'miedzy-nami-nic-nie-bylo', 'poezye'])
+        self.assertEqual(removed, [])
+        self.assertEqual(
+            set(errors), {
+                os.path.join(self.books, 'abstrakt.xml'),
+                os.path.join(self.books, 'asnyk_miedzy_nami_nodc.xml'),
+            })
+
+        file_name = os.path.join(self.books, 'asnyk_zbior.xml')
+        self.assertEqual(
+            self.index.get('poezye'), dcparser.parse(file_name).to_dict())
+        self.assertEqual(
+            self.index.get_info('poezye').to_dict(),
+            dcparser.parse(file_name).to_dict())
+        self.assertEqual(
+            self.index.get_parts('poezye'),
+            ['miedzy-nami-nic-nie-bylo', 'do-mlodych'])
+        self.assertEqual(self.index.get_parents('do-mlodych'), ['poezye'])
+        with self.assertRaises(KeyError):
+            self.index.get('nonexistent')
+
+        # Nothing changed.
+        self.assertEqual(self.index.update(self.books)[:2], ([], []))
+
+        # Touched, but not changed.
+        os.utime(file_name, ns=(0, 0))
+        self.assertEqual(self.index.update(self.books)[:2], ([], []))
+
+        os.remove(file_name)
+        updated, removed, errors = self.index.update(self.books)
+        self.assertEqual(removed, ['poezye'])
+        self.assertNotIn('poezye', self.index)
+        self.assertEqual(self.index.get_parents('do-mlodych'), [])
+
+    def test_update_changed(self):
+        self.index.update(self.books)
+        file_name = os.path.join(self.books, 'do-mlodych.xml')
+        with open(file_name, 'rb') as f:
+            xml = f.read()
+        with open(file_name, 'wb') as f:
+            f.write(xml.replace(b'Do m\xc5\x82odych', b'Changed'))
+        updated, removed, errors = self.index.update(self.books)
+        self.assertEqual(updated, ['do-mlodych'])
+        self.assertEqual(self.index.get('do-mlodych')['title'], 'Changed')
+
+    def test_update_failed(self):
+        updated, removed, errors = self.index.update(self.books)
+        self.assertEqual(self.index.get_errors(), errors)
+
+        # Broken files are not read again until they change.
+        file_name = os.path.join(self.books, 'abstrakt.xml')
+        os.utime(file_name, ns=(0, 0))
+        self.assertEqual(self.index.update(self.books), ([], [], {}))
+        self.assertIn(file_name, self.index.get_errors())
+
+    def test_duplicate_slug(self):
+        self.index.update(self.books)
+        original = os.path.join(self.books, 'do-mlodych.xml')
+        copy = os.path.join(self.books, 'zz-copy.xml')
+        shutil.copy(original, copy)
+
+        updated, removed, errors = self.index.update(self.books)
+        self.assertEqual((updated, removed), ([], []))
+        self.assertEqual(list(errors), [copy])
+        self.assertEqual(self.index.get_file_name('do-mlodych'), original)
+
+        # The index doesn't flip between the files.
+        self.assertEqual(self.index.update(self.books), ([], [], {}))
+        self.assertEqual(self.index.get_file_name('do-mlodych'), original)
+
+        # The copy takes over when the original is gone.
+        os.remove(original)
+        updated, removed, errors = self.index.update(self.books)
+        self.assertEqual((updated, removed), (['do-mlodych'], ['do-mlodych']))
+        self.assertEqual(self.index.get_file_name('do-mlodych'), copy)
+        self.assertNotIn(copy, self.index.get_errors())
+
+    def test_update_unexpected_error(self):
+        with open(os.path.join(self.books, 'do-mlodych.xml'), 'rb') as f:
+            xml = f.read()
+        bad = os.path.join(self.books, 'bad.xml')
+        with open(bad, 'wb') as f:
+            # Person.from_text raises ValueError for this.
+            f.write(xml.replace(b'>Asnyk, Adam<', b'>a, b, c<'))
+        updated, removed, errors = self.index.update(self.books)
+        self.assertIn(bad, errors)
+        self.assertIn('do-mlodych', updated)
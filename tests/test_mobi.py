@@ -6,11 +6,24 @@ from zipfile import ZipFile
 from lxml import html
 from librarian import DirDocProvider
 from librarian.builders import MobiBuilder
+from librarian.builders.mobi import iter_texts
 from librarian.document import WLDocument
 from tests.utils import get_fixture
 
 
 class MobiTests(unittest.TestCase):
+    def test_iter_texts(self):
+        document = WLDocument(
+            get_fixture('text', 'asnyk_zbior.xml'),
+            provider=DirDocProvider(get_fixture('text', ''))
+        )
+        texts = list(iter_texts(document))
+        for child in document.children:
+            for text in child.tree.getroot().itertext():
+                self.assertIn(text, texts)
+        self.assertGreater(
+            len(texts), len(list(document.tree.getroot().itertext())))
+
     def test_transform(self):
         mobi = MobiBuilder().build(
             WLDocument(
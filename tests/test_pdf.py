@@ -4,8 +4,14 @@
 import re
 from tempfile import NamedTemporaryFile
 import unittest
+from lxml import etree
 from librarian import DirDocProvider
 from librarian.parser import WLDocument
+try:
+    from librarian.pdf import split_scripts, wrap_scripts
+except ImportError:
+    # librarian.pdf requires Texml.
+    split_scripts = wrap_scripts = None
 from .utils import get_fixture
 
 
@@ -23,3 +29,44 @@ class PdfTests(unittest.TestCase):
         # Check contributor list.
         editors = re.search(r'\\def\\editors\{Opracowanie redakcyjne i przypisy: ([^}]*?)\.\s*\}', tex)
         self.assertEqual(editors.group(1), "Adam Fikcyjny, Aleksandra Sekuła, Olga Sutkowska")
+
+
+
+@unittest.skipIf(wrap_scripts is None, 'librarian.pdf requires Texml')
+class ScriptsTests(unittest.TestCase):
+    def test_split_scripts(self):
+        root = etree.Element('a')
+        text, wrappers = split_scripts(root, 'abc Жук ■ and אב.')
+        self.assertEqual(text, 'abc ')
+        self.assertEqual(
+            [(w.tag, w.text, w.tail) for w in wrappers], [
+                ('alien', 'Жук', ' '),
+                ('alien', '■', ' and '),
+                ('fallback', 'אב', '.'),
+            ])
+
+    def test_wrap_scripts(self):
+        source = (
+            '<utwor><akap title="Жук">Ala Жук<slowo_obce>Жук</slowo_obce> '
+            'i ■■ oraz שלום</akap>Кот<akap/>tail ■</utwor>'
+        )
+        root = etree.fromstring(source)
+        wrap_scripts(root)
+        self.assertEqual(
+            etree.tostring(root, encoding='unicode'),
+            '<utwor><akap title="Жук">Ala <alien>Жук</alien>'
+            '<slowo_obce><alien>Жук</alien></slowo_obce> '
+            'i <alien>■■</alien> oraz <fallback>שלום</fallback></akap>'
+            '<alien>Кот</alien><akap/>tail <alien>■</alien></utwor>'
+        )
+
+        # Same as the substitutions on the serialized document used to give,
+        # where there were no attributes to break.
+        source = source.replace(' title="Жук"', '')
+        text = source
+        text = re.sub(r"([\u0400-\u04ff]+)", r"<alien>\1</alien>", text)
+        text = re.sub(r"([\u25a0-\u25ff]+)", r"<alien>\1</alien>", text)
+        text = re.sub(r"([\u0590-\u05ff]+)", r"<fallback>\1</fallback>", text)
+        root = etree.fromstring(source)
+        wrap_scripts(root)
+        self.assertEqual(etree.tostring(root, encoding='unicode'), text)
@@ -0,0 +1,188 @@
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
+#
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from unittest import TestCase
+from librarian import DirDocProvider
+from librarian.document import WLDocument
+from librarian.builders import builders
+from librarian.providers import (ArchiveDocProvider, CachingDocProvider,
+                                 SQLiteDocProvider)
+from .utils import get_fixture
+
+
+class CountingProvider(DirDocProvider):
+    def __init__(self, dir_):
+        super().__init__(dir_)
+        self.loaded = []
+
+    def by_slug(self, slug):
+        self.loaded.append(slug)
+        return super().by_slug(slug)
+
+
+class CachingDocProviderTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        for name in ('asnyk_zbior', 'miedzy-nami-nic-nie-bylo', 'do-mlodych'):
+            shutil.copy(get_fixture('text', name + '.xml'), self.dir)
+
+    def test_cache(self):
+        backend = CountingProvider(self.dir)
+        provider = CachingDocProvider(backend)
+
+        with provider.by_slug('do-mlodych') as f:
+            data = f.read()
+        with provider.by_slug('do-mlodych') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(backend.loaded, ['do-mlodych'])
+
+        # Changed files are read again.
+        path = os.path.join(self.dir, 'do-mlodych.xml')
+        with open(path, 'ab') as f:
+            f.write(b'\n')
+        with provider.by_slug('do-mlodych') as f:
+            self.assertEqual(f.read(), data + b'\n')
+        self.assertEqual(len(backend.loaded), 2)
+
+    def test_no_stat(self):
+        class NoStatProvider(CountingProvider):
+            def stat(self, slug):
+                return None
+
+        backend = NoStatProvider(self.dir)
+        provider = CachingDocProvider(backend)
+        provider.get_bytes('do-mlodych')
+        provider.get_bytes('do-mlodych')
+        # Can't be revalidated, so it's read every time.
+        self.assertEqual(backend.loaded, ['do-mlodych', 'do-mlodych'])
+        self.assertNotIn('do-mlodych', provider.cache)
+
+    def test_limit(self):
+        backend = CountingProvider(self.dir)
+        size = os.path.getsize(os.path.join(self.dir, 'do-mlodych.xml'))
+        provider = CachingDocProvider(backend, max_bytes=size)
+
+        provider.get_bytes('do-mlodych')
+        provider.get_bytes('miedzy-nami-nic-nie-bylo')
+        self.assertLessEqual(provider.size, size)
+        self.assertNotIn('do-mlodych', provider.cache)
+
+    def test_prefetch(self):
+        backend = CountingProvider(self.dir)
+        provider = CachingDocProvider(backend)
+        provider.prefetch(['miedzy-nami-nic-nie-bylo', 'nonexistent'])
+        self.assertEqual(backend.loaded, ['miedzy-nami-nic-nie-bylo'])
+
+        doc = WLDocument(
+            filename=get_fixture('text', 'asnyk_zbior.xml'),
+            provider=provider
+        )
+        self.assertTrue(list(doc.children))
+        self.assertEqual(backend.loaded.count('miedzy-nami-nic-nie-bylo'), 1)
+
+
+class ArchiveDocProviderTests(TestCase):
+    slugs = ('asnyk_zbior', 'miedzy-nami-nic-nie-bylo', 'do-mlodych')
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def check_archive(self, path):
+        with ArchiveDocProvider(path) as provider:
+            for slug in self.slugs:
+                with open(get_fixture('text', slug + '.xml'), 'rb') as f:
+                    self.assertEqual(provider.by_slug(slug).read(), f.read())
+            with self.assertRaises(FileNotFoundError):
+                provider.by_slug('nonexistent')
+
+            doc = WLDocument(
+                filename=provider.by_slug('asnyk_zbior'),
+                provider=provider
+            )
+            self.assertEqual(len(list(doc.children)), 2)
+
+    def test_zip(self):
+        for compression in (
+                zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2):
+            path = os.path.join(self.dir, 'corpus.zip')
+            with zipfile.ZipFile(path, 'w', compression) as z:
+                for slug in self.slugs:
+                    z.write(get_fixture('text', slug + '.xml'), 'xml/' + slug + '.xml')
+            self.check_archive(path)
+
+    def test_tar(self):
+        path = os.path.join(self.dir, 'corpus.tar')
+        with tarfile.open(path, 'w') as tar:
+            for slug in self.slugs:
+                tar.add(get_fixture('text', slug + '.xml'), slug + '.xml')
+        self.check_archive(path)
+
+
+class SQLiteDocProviderTests(TestCase):
+    slugs = ('asnyk_zbior', 'miedzy-nami-nic-nie-bylo', 'do-mlodych')
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.provider = SQLiteDocProvider(os.path.join(self.dir, 'db.sqlite'))
+        self.addCleanup(self.provider.close)
+
+        documents = []
+        for slug in self.slugs:
+            with open(get_fixture('text', slug + '.xml'), 'rb') as f:
+                documents.append((slug, f.read()))
+        self.provider.add_documents(documents)
+
+    def test_documents(self):
+        provider = self.provider
+        doc = WLDocument(
+            filename=provider.by_slug('asnyk_zbior'),
+            provider=provider
+        )
+        self.assertEqual(len(list(doc.children)), 2)
+        with self.assertRaises(FileNotFoundError):
+            provider.by_slug('nonexistent')
+
+    def test_outputs(self):
+        provider = self.provider
+        self.assertEqual(provider.get_stale('txt'), sorted(self.slugs))
+
+        version, xml = provider.get_document('do-mlodych')
+        doc = WLDocument(filename=io.BytesIO(xml))
+        output = doc.build(builders['txt'])
+        provider.save_output('do-mlodych', 'txt', version, output)
+        self.assertEqual(
+            provider.get_output('do-mlodych', 'txt').get_bytes(),
+            output.get_bytes()
+        )
+        self.assertIsNone(
+            provider.get_output('do-mlodych', 'txt', {'raw_text': True}))
+        self.assertNotIn('do-mlodych', provider.get_stale('txt'))
+
+        # Updating the document makes the output stale.
+        provider.add_documents([
+            ('do-mlodych', provider.by_slug('do-mlodych').read())
+        ])
+        self.assertIsNone(provider.get_output('do-mlodych', 'txt'))
+        self.assertIn('do-mlodych', provider.get_stale('txt'))
+
+    def test_changed_while_building(self):
+        provider = self.provider
+        version, xml = provider.get_document('do-mlodych')
+        output = WLDocument(filename=io.BytesIO(xml)).build(builders['txt'])
+
+        # The document changes before the output is saved.
+        new_version = provider.add_documents([('do-mlodych', xml + b'\n')])
+        self.assertGreater(new_version, version)
+        provider.save_output('do-mlodych', 'txt', version, output)
+
+        self.assertIsNone(provider.get_output('do-mlodych', 'txt'))
+        self.assertIn('do-mlodych', provider.get_stale('txt'))
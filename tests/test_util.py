@@ -0,0 +1,37 @@
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Wolne Lektury. See NOTICE for more information.
+#
+import unittest
+from librarian.elements.base import WLElement
+from librarian.util import TextNormalizer, get_normalizer
+
+
+class TextNormalizerTests(unittest.TestCase):
+    def test_substitutions(self):
+        normalizer = TextNormalizer(WLElement.text_substitutions)
+        text = '-----,,,"a﻿" \'b\' -﻿--'
+        expected = text
+        for old, new in WLElement.text_substitutions:
+            expected = expected.replace(old, new)
+        self.assertEqual(normalizer(text), expected)
+        self.assertEqual(TextNormalizer([])('a -- b'), 'a -- b')
+
+    def test_orphans(self):
+        normalizer = TextNormalizer([], orphans=True)
+        self.assertEqual(
+            normalizer('w domu i  tam, a w\nsieni'),
+            'w domu i\u00a0tam, a\u00a0w\u00a0sieni')
+
+    def test_get_normalizer(self):
+        # A builder which knows nothing about normalizers.
+        class Builder:
+            orphans = False
+
+        builder = Builder()
+        substitutions = [('a', 'b')]
+        normalizer = get_normalizer(builder, substitutions)
+        self.assertIs(get_normalizer(builder, substitutions), normalizer)
+        builder.orphans = True
+        self.assertIsNot(get_normalizer(builder, substitutions), normalizer)
+        self.assertEqual(
+            get_normalizer(builder, substitutions)(' a a'), ' b\u00a0b')